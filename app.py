@@ -3,13 +3,46 @@ import re
 import json
 import shutil
 import html
-from flask import Flask, request, jsonify, render_template_string, send_from_directory
+from flask import Flask, Response, request, jsonify, render_template_string, send_from_directory
 import markdown
 from markdown.extensions.codehilite import CodeHiliteExtension
+from markdown.extensions.toc import slugify, unique
 from werkzeug.utils import secure_filename
+from urllib.parse import unquote, quote
+from werkzeug.http import parse_options_header
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
 import uuid
+import hashlib
+import atexit
+import tempfile
+import zipfile
+import tarfile
 import time
+import bisect
+import subprocess
 import logging
+import threading
+import sys
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    # Optional: pure-Python TeX -> MathML for server_math without KaTeX
+    from latex2mathml.converter import convert as latex_to_mathml
+except ImportError:
+    latex_to_mathml = None
+
+try:
+    # Optional: syntax highlighting of fenced code blocks
+    from pygments import highlight as pygments_highlight
+    from pygments.lexers import get_lexer_by_name
+    from pygments.formatters import HtmlFormatter
+    from pygments.util import ClassNotFound
+except ImportError:
+    pygments_highlight = None
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -32,13 +65,40 @@ PAGE_TITLE = settings.get("page_title", "Default Page Title")
 EDITOR_THEME = settings.get("editor_theme", "default")
 AUTO_SAVE_INTERVAL = settings.get("auto_save_interval", 30)  # seconds
 
+# Rendering settings
+RENDER_CHUNK_SIZE = settings.get("render_chunk_size_kb", 64) * 1024  # larger notes render in lazily loaded chunks
+RENDER_CACHE_MB = settings.get("render_cache_mb", 64)  # rendered chunks kept in memory
+SERVER_MATH = settings.get("server_math", False)  # typeset $...$ / $$...$$ on the server
+KATEX_PATH = settings.get("katex_path", "katex")  # KaTeX CLI used by server_math
+SERVER_MERMAID = settings.get("server_mermaid", False)  # render ```mermaid blocks to SVG on the server
+MMDC_PATH = settings.get("mmdc_path", "mmdc")  # mermaid-cli used by server_mermaid
+
+# Content cache settings
+CACHE_MEMORY_LIMIT_MB = settings.get("cache_memory_limit_mb", 256)  # 0 = unbounded
+CACHE_COLD_STORAGE = settings.get("cache_cold_storage", "compress")  # "compress" or "disk"
+SEARCH_INDEX_MEMORY_MB = settings.get("search_index_memory_mb", 128)  # trigram index budget, 0 = unbounded
+LAZY_LOAD = settings.get("lazy_load", False)  # scan metadata only at startup, prefetch bodies in background
+READ_WORKERS = settings.get("read_workers", 8)  # parallel file reads during full scans
+WRITE_BEHIND = settings.get("write_behind", False)  # coalesce autosaves, written within auto_save_interval
+UPLOAD_WORKERS = settings.get("upload_workers", 4)  # parallel fsync/rename of uploaded files
+MAX_UPLOAD_SIZE_MB = settings.get("max_upload_size_mb", 1024)  # streaming uploads bypass MAX_CONTENT_LENGTH
+
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
 # Global variables for file management
 file_tree = {}
 file_cache = {}
+vault_dirs = set()  # Relative paths of every directory in file_tree
 file_locks = {}  # Track file locks for concurrent editing
+note_lock = threading.RLock()  # Serializes version checks with the mutation that follows
+search_index = None  # SearchIndex over file_cache, built on startup
+link_index = None  # LinkIndex of links between notes, built alongside search_index
+name_index = None  # NameIndex resolving [[wiki-link]] names to note paths
+link_report = None  # LinkReport of broken links and orphaned notes, kept up to date in the background
+meta_index = None  # MetadataIndex of parsed frontmatter per note
+outline_index = None  # OutlineIndex of the headings of every note
+render_generation = 0  # Bumped when notes, names or directories change, so cached renders re-resolve links
 
 # Global HTML template - moved here so it's accessible to all route handlers
 html_template = """
@@ -689,6 +749,19 @@ html_template = """
         .wiki-link:hover {
             text-decoration: underline;
         }
+        .broken-link {
+            color: #b0b0b0;
+            text-decoration: line-through;
+        }
+        
+        /* Mermaid diagrams rendered on the server */
+        .mermaid-svg {
+            text-align: center;
+        }
+        .mermaid-svg svg {
+            max-width: 100%;
+            height: auto;
+        }
         
         /* Tags */
         .tag {
@@ -865,12 +938,12 @@ html_template = """
             uploadFilesBtn.disabled = true;
             
             const formData = new FormData();
-            files.forEach(file => {
-                formData.append('files', file);
-            });
             if (targetDir) {
                 formData.append('target_dir', targetDir);
             }
+            files.forEach(file => {
+                formData.append('files', file);
+            });
             
             fetch('/api/file/upload', {
                 method: 'POST',
@@ -1026,6 +1099,9 @@ html_template = """
                         <p>${data.error}</p>
                     </div>`;
                 } else {
+                    viewedFilePath = filePath;
+                    viewedFileVersion = data.version;
+
                     // Add an H3 title using the file name (minus .md) + EXTRA BR
                     const baseName = filePath.split("/").pop();
                     const displayName = stripMdExtension(baseName);
@@ -1064,6 +1140,13 @@ html_template = """
                         highlightEl.scrollIntoView({ behavior: 'smooth', block: 'center' });
                     }
                     
+                    // Large notes arrive in chunks; fetch the rest while scrolling
+                    if (data.chunks > 1) {
+                        loadRemainingChunks(filePath, data.version, data.chunks);
+                    } else if (chunkObserver) {
+                        chunkObserver.disconnect();
+                    }
+                    
                     // Re-initialize Mermaid for new content
                     setTimeout(() => {
                         renderMermaidDiagrams();
@@ -1084,6 +1167,65 @@ html_template = """
             }
         }
 
+        // ---------------------------
+        //  Lazy chunks of large notes
+        // ---------------------------
+        let chunkObserver = null;
+
+        function loadRemainingChunks(filePath, version, total) {
+            if (chunkObserver) {
+                chunkObserver.disconnect();
+            }
+            const container = document.querySelector("#content .viewer-container");
+            const sentinel = document.createElement("div");
+            sentinel.className = "chunk-sentinel text-muted";
+            sentinel.textContent = "Loading...";
+            container.appendChild(sentinel);
+
+            let next = 1;
+            let loading = false;
+            const observer = new IntersectionObserver(async (entries) => {
+                if (loading || !entries.some(entry => entry.isIntersecting)) {
+                    return;
+                }
+                loading = true;
+                try {
+                    const resp = await fetch("/api/file/chunk?path=" + encodeURIComponent(filePath)
+                        + "&index=" + next + "&version=" + encodeURIComponent(version));
+                    const data = await resp.json();
+                    if (observer !== chunkObserver) {
+                        return;  // Another note was opened meanwhile
+                    }
+                    if (data.error) {
+                        observer.disconnect();
+                        sentinel.textContent = data.conflict
+                            ? "This note has changed since it was opened. Reload it to see the rest."
+                            : data.error;
+                        return;
+                    }
+                    sentinel.insertAdjacentHTML("beforebegin", data.html);
+                    next += 1;
+                    if (next >= total) {
+                        observer.disconnect();
+                        sentinel.remove();
+                    } else {
+                        // Re-observe so a sentinel that is still visible triggers again
+                        observer.unobserve(sentinel);
+                        observer.observe(sentinel);
+                    }
+                    setTimeout(() => {
+                        renderMermaidDiagrams();
+                    }, 200);
+                } catch (error) {
+                    console.error("Error loading note chunk:", error);
+                } finally {
+                    loading = false;
+                }
+            }, { rootMargin: "1000px 0px" });
+            chunkObserver = observer;
+            observer.observe(sentinel);
+        }
+
         // ---------------------------
         //  Load file with highlight
         // ---------------------------
@@ -1264,7 +1406,28 @@ html_template = """
         let editor = null;
         let currentFilePath = null;
         let currentLockId = null;
+        let currentVersion = null;     // Server version of lastSavedContent
+        let lastSavedContent = null;   // Base text that patches are computed against
         let autoSaveInterval = null;
+        let viewedFilePath = null;     // File shown in the viewer and its content version
+        let viewedFileVersion = null;
+
+        // Describe the edit from oldText to newText as a single splice
+        // (common prefix and suffix trimmed), in JavaScript string indices.
+        function computeTextPatch(oldText, newText) {
+            let start = 0;
+            const minLength = Math.min(oldText.length, newText.length);
+            while (start < minLength && oldText[start] === newText[start]) {
+                start++;
+            }
+            let oldEnd = oldText.length;
+            let newEnd = newText.length;
+            while (oldEnd > start && newEnd > start && oldText[oldEnd - 1] === newText[newEnd - 1]) {
+                oldEnd--;
+                newEnd--;
+            }
+            return { start: start, end: oldEnd, text: newText.slice(start, newEnd) };
+        }
         
         async function editFile(filePath) {
             // Hide the viewer and show the editor
@@ -1349,6 +1512,8 @@ html_template = """
                 
                 // Set the content
                 editor.setValue(data.content);
+                currentVersion = data.version;
+                lastSavedContent = data.content;
                 
                 // Set up auto-save
                 if (autoSaveInterval) {
@@ -1370,23 +1535,52 @@ html_template = """
             
             try {
                 const content = editor.getValue();
-                const resp = await fetch('/api/file/edit', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
-                    body: JSON.stringify({
-                        path: currentFilePath,
-                        content: content,
-                        lock_id: currentLockId
-                    })
-                });
+                let resp;
+                if (currentVersion && lastSavedContent !== null) {
+                    // Nothing changed since the last save
+                    if (isAutoSave && content === lastSavedContent) return;
+
+                    // Send only the changed span against the last saved version
+                    const patch = computeTextPatch(lastSavedContent, content);
+                    resp = await fetch('/api/file/patch', {
+                        method: 'POST',
+                        headers: {
+                            'Content-Type': 'application/json'
+                        },
+                        body: JSON.stringify({
+                            path: currentFilePath,
+                            base_version: currentVersion,
+                            patches: content === lastSavedContent ? [] : [patch],
+                            lock_id: currentLockId,
+                            auto_save: isAutoSave
+                        })
+                    });
+                } else {
+                    const headers = { 'Content-Type': 'application/json' };
+                    if (currentVersion) headers['If-Match'] = `"${currentVersion}"`;
+                    resp = await fetch('/api/file/edit', {
+                        method: 'POST',
+                        headers: headers,
+                        body: JSON.stringify({
+                            path: currentFilePath,
+                            content: content,
+                            lock_id: currentLockId,
+                            auto_save: isAutoSave
+                        })
+                    });
+                }
                 
                 const data = await resp.json();
                 if (data.error) {
-                    showToast(data.error, 'danger');
+                    if (data.conflict) {
+                        showToast('This file was changed elsewhere since you opened it. Copy your changes and reopen the file.', 'danger');
+                    } else {
+                        showToast(data.error, 'danger');
+                    }
                     return;
                 }
+                currentVersion = data.version;
+                lastSavedContent = content;
                 
                 if (!isAutoSave) {
                     showToast('File saved successfully', 'success');
@@ -1415,6 +1609,8 @@ html_template = """
                     // Reset the editor state
                     currentLockId = null;
                     currentFilePath = null;
+                    currentVersion = null;
+                    lastSavedContent = null;
                     
                     // Hide the editor and show the viewer
                     document.querySelector('.editor-container').style.display = 'none';
@@ -1461,6 +1657,8 @@ html_template = """
                     // Reset the editor state
                     currentLockId = null;
                     currentFilePath = null;
+                    currentVersion = null;
+                    lastSavedContent = null;
                     
                     // Hide the editor and show the viewer
                     document.querySelector('.editor-container').style.display = 'none';
@@ -1557,11 +1755,14 @@ html_template = """
             }
             
             try {
+                const headers = { 'Content-Type': 'application/json' };
+                if (filePath === viewedFilePath && viewedFileVersion) {
+                    // Refuse to delete a version the user has not seen
+                    headers['If-Match'] = `"${viewedFileVersion}"`;
+                }
                 const resp = await fetch('/api/file/delete', {
                     method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
+                    headers: headers,
                     body: JSON.stringify({
                         path: filePath
                     })
@@ -2560,105 +2761,296 @@ html_template = """
 """
 
 # -------------------------------------------------------------------
-# Helpers
+# Content cache
 # -------------------------------------------------------------------
-def build_file_tree(root):
-    """
-    Recursively build a nested list structure representing
-    the folder/file hierarchy under 'root'.
-    Skip the '.obsidian' directory and files starting with '._'.
-    """
-    tree = []
-    with os.scandir(root) as it:
-        # Sort directories first (alphabetically), then files
-        for entry in sorted(it, key=lambda e: (not e.is_dir(), e.name.lower())):
-            # Skip .obsidian
-            if entry.is_dir() and entry.name == ".obsidian":
-                continue
+class ContentStore:
+    """
+    Tiered, memory-bounded cache of note contents keyed by relative path.
+    Recently used notes are kept decoded ("hot") in LRU order. Once the
+    resident size passes 'memory_limit' bytes, the least recently used notes
+    are demoted to the cold tier: zlib-compressed bytes ("compress"), or
+    dropped and re-read from disk on next access ("disk"). Compressed notes
+    that still don't fit are dropped to disk as well. Reading a cold note
+    promotes it back to the hot tier. Notes registered with add_unloaded()
+    start out on disk and are read on first access. Only note bodies count
+    against the limit; the per-note indexes are held separately.
+    Supports the dict operations the app uses on file_cache.
+    """
 
-            # Skip files starting with '.' or '._'
-            if not entry.is_dir() and entry.name.startswith("."):
-                continue
+    def __init__(self, root, memory_limit=None, cold_storage="compress"):
+        self.root = root
+        self.memory_limit = memory_limit
+        self.cold_storage = cold_storage
+        self.hot = OrderedDict()   # path -> str, least recently used first
+        self.cold = OrderedDict()  # path -> compressed bytes, or None if only on disk
+        self.hot_bytes = 0
+        self.cold_bytes = 0
+        self.lock = threading.RLock()
+
+    def __contains__(self, rel_path):
+        return rel_path in self.hot or rel_path in self.cold
+
+    def __len__(self):
+        return len(self.hot) + len(self.cold)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        with self.lock:
+            return list(self.hot) + list(self.cold)
+
+    def __getitem__(self, rel_path):
+        with self.lock:
+            if rel_path in self.hot:
+                self.hot.move_to_end(rel_path)
+                return self.hot[rel_path]
+            if rel_path not in self.cold:
+                raise KeyError(rel_path)
+            data = self.cold[rel_path]
+            if data is not None:
+                content = zlib.decompress(data).decode("utf-8")
+                self._store_hot(rel_path, content)
+                return content
+        # Read outside the lock so other requests are not blocked on disk I/O
+        content = self._read(rel_path)
+        with self.lock:
+            if self.cold.get(rel_path, False) is None:
+                if content is None:
+                    # The file disappeared or became unreadable since it was cached
+                    del self.cold[rel_path]
+                    raise KeyError(rel_path)
+                self._store_hot(rel_path, content)
+                return content
+            # Stored, removed or read by another request in the meantime
+            return self[rel_path]
+
+    def __setitem__(self, rel_path, content):
+        with self.lock:
+            self._discard(rel_path)
+            self._store_hot(rel_path, content)
+
+    def __delitem__(self, rel_path):
+        with self.lock:
+            if rel_path not in self:
+                raise KeyError(rel_path)
+            self._discard(rel_path)
+
+    def get(self, rel_path, default=None):
+        try:
+            return self[rel_path]
+        except KeyError:
+            return default
+
+    def peek(self, rel_path, default=None):
+        """
+        Return a note's content without promoting it, for bulk scans like search.
+        """
+        with self.lock:
+            if rel_path in self.hot:
+                return self.hot[rel_path]
+            if rel_path not in self.cold:
+                return default
+            data = self.cold[rel_path]
+            if data is not None:
+                return zlib.decompress(data).decode("utf-8")
+        content = self._read(rel_path)
+        if content is None:
+            with self.lock:
+                if self.cold.get(rel_path, False) is None:
+                    del self.cold[rel_path]
+            return default
+        return content
+
+    def add_unloaded(self, rel_path):
+        """
+        Register a note that is only on disk; the body is read on first access.
+        """
+        with self.lock:
+            self._discard(rel_path)
+            self.cold[rel_path] = None
+
+    def prefetch(self, rel_path):
+        """
+        Read a note that is only on disk. It is kept (as least recently used)
+        only if it fits under the memory limit. Returns the content, or None.
+        """
+        with self.lock:
+            if rel_path in self.hot:
+                return self.hot[rel_path]
+            if rel_path not in self.cold:
+                return None
+            if self.cold[rel_path] is not None:
+                return zlib.decompress(self.cold[rel_path]).decode("utf-8")
+        # Read outside the lock so requests are never blocked on prefetch I/O
+        content = self._read(rel_path)
+        if content is None:
+            return None
+        with self.lock:
+            size = sys.getsizeof(content)
+            fits = not self.memory_limit or self.hot_bytes + self.cold_bytes + size <= self.memory_limit
+            if fits and rel_path in self.cold and self.cold[rel_path] is None:
+                self._store_hot(rel_path, content)
+                self.hot.move_to_end(rel_path, last=False)
+        return content
+
+    def pop(self, rel_path, default=None):
+        content = self.peek(rel_path, default)
+        with self.lock:
+            self._discard(rel_path)
+        return content
+
+    def items(self):
+        """
+        Yield (path, content) pairs without disturbing the LRU order.
+        """
+        for rel_path in self.keys():
+            content = self.peek(rel_path)
+            if content is not None:
+                yield rel_path, content
+
+    def _read(self, rel_path):
+        """
+        Read a note that is only on disk, or None if it cannot be read.
+        Called without the lock held.
+        """
+        full_path = os.path.join(self.root, rel_path)
+        # An autosave still queued for write-behind is newer than the disk copy
+        content = write_queue.get(full_path)
+        if content is None:
+            content = get_file_content(full_path)
+        return content
+
+    def _discard(self, rel_path):
+        if rel_path in self.hot:
+            self.hot_bytes -= sys.getsizeof(self.hot.pop(rel_path))
+        elif rel_path in self.cold:
+            data = self.cold.pop(rel_path)
+            if data is not None:
+                self.cold_bytes -= len(data)
+
+    def _store_hot(self, rel_path, content):
+        self._discard(rel_path)
+        self.hot[rel_path] = content
+        self.hot_bytes += sys.getsizeof(content)
+        self._evict()
+
+    def _evict(self):
+        if not self.memory_limit:
+            return
+        # Demote least recently used notes, always keeping the newest one hot
+        while self.hot_bytes + self.cold_bytes > self.memory_limit and len(self.hot) > 1:
+            rel_path, content = self.hot.popitem(last=False)
+            self.hot_bytes -= sys.getsizeof(content)
+            if self.cold_storage == "compress":
+                data = zlib.compress(content.encode("utf-8"))
+                self.cold[rel_path] = data
+                self.cold_bytes += len(data)
+            else:
+                self.cold[rel_path] = None
+        # Compressed notes that still don't fit fall back to disk
+        if self.hot_bytes + self.cold_bytes > self.memory_limit:
+            for rel_path, data in self.cold.items():
+                if self.hot_bytes + self.cold_bytes <= self.memory_limit:
+                    break
+                if data is not None:
+                    self.cold[rel_path] = None
+                    self.cold_bytes -= len(data)
 
+
+# -------------------------------------------------------------------
+# Helpers
+# -------------------------------------------------------------------
+def scan_vault(root):
+    """
+    Walk the vault once and return (tree, notes, directories):
+    - tree: the nested list structure served by /api/tree, directories first
+      (alphabetically), then .md files
+    - notes: (rel_path, size, mtime) for every .md file, taken from the same
+      DirEntry stat results
+    - directories: set of the relative paths of every directory in the tree
+    Skip the '.obsidian' directory and files starting with '.' or '._'.
+    Relative paths are built up while descending instead of via os.path.relpath.
+    """
+    notes = []
+    directories = set()
+
+    def walk(path, prefix):
+        with os.scandir(path) as it:
+            # Sort directories first (alphabetically), then files
+            entries = sorted(it, key=lambda e: (not e.is_dir(), e.name.lower()))
+        tree = []
+        for entry in entries:
+            rel_path = prefix + entry.name
             if entry.is_dir():
-                subtree = build_file_tree(entry.path)
+                # Skip .obsidian
+                if entry.name == ".obsidian":
+                    continue
+                directories.add(rel_path)
                 tree.append({
                     "type": "directory",
                     "name": entry.name,
-                    "path": os.path.relpath(entry.path, CONTENT_ROOT).replace(os.sep, "/"),
-                    "children": subtree
+                    "path": rel_path.replace(os.sep, "/"),
+                    "children": walk(entry.path, rel_path + os.sep)
                 })
-            else:
-                if entry.name.lower().endswith(".md"):
-                    tree.append({
-                        "type": "file",
-                        "name": entry.name,
-                        "path": os.path.relpath(entry.path, CONTENT_ROOT).replace(os.sep, "/")
-                    })
-    return tree
+            # Skip files starting with '.' or '._'
+            elif not entry.name.startswith(".") and entry.name.lower().endswith(".md"):
+                st = entry.stat()
+                notes.append((rel_path, st.st_size, st.st_mtime))
+                tree.append({
+                    "type": "file",
+                    "name": entry.name,
+                    "path": rel_path.replace(os.sep, "/")
+                })
+        return tree
+
+    tree = walk(root, "")
+    return tree, notes, directories
 
-def cache_files(root):
+def cache_files(root, notes=None):
     """
-    Recursively scan the root directory for .md files and cache their content.
-    Skip the '.obsidian' directory so it doesn't appear in search results,
-    and also skip files starting with '._'.
+    Cache the content of the .md files listed in 'notes' (as produced by
+    scan_vault; the vault is scanned if not given).
+    Returns a ContentStore bounded by the cache_memory_limit_mb setting.
+    With lazy_load enabled only the scanned paths are registered; bodies are
+    read on first access or by prefetch_file_cache.
     """
-    cache = {}
-    for dirpath, dirnames, filenames in os.walk(root):
-        if ".obsidian" in dirnames:
-            dirnames.remove(".obsidian")
-
-        for filename in filenames:
-            # Skip files starting with '.' or '._'
-            if filename.startswith("."):
-                continue
-
-            if filename.lower().endswith(".md"):
-                full_path = os.path.join(dirpath, filename)
-                rel_path = os.path.relpath(full_path, CONTENT_ROOT)
-                try:
-                    with open(full_path, "r", encoding="utf-8") as f:
-                        cache[rel_path] = f.read()
-                except Exception as e:
-                    print(f"Error reading {full_path}: {e}")
+    if notes is None:
+        notes = scan_vault(root)[1]
+    cache = ContentStore(
+        root,
+        memory_limit=CACHE_MEMORY_LIMIT_MB * 1024 * 1024,
+        cold_storage=CACHE_COLD_STORAGE,
+    )
+    if LAZY_LOAD:
+        for rel_path, size, mtime in notes:
+            cache.add_unloaded(rel_path)
+        return cache
+
+    rel_paths = [rel_path for rel_path, size, mtime in notes]
+    full_paths = [os.path.join(root, rel_path) for rel_path in rel_paths]
+    for rel_path, content in zip(rel_paths, read_files(full_paths)):
+        if content is not None:
+            cache[rel_path] = content
     return cache
 
-def search_in_files(query, cache):
+def read_files(full_paths):
     """
-    Naive substring search across all cached .md files.
-    Returns a list of { path, matches: [{ snippet, start, length }, ...] }.
+    Read files through a bounded thread pool of read_workers threads and yield
+    their contents in input order (None for a file that could not be read, so
+    one failure never aborts the batch). At most a few reads per worker are
+    in flight or waiting to be consumed, which keeps memory bounded.
     """
-    results = []
-    query_lower = query.lower()
-
-    for path, content in cache.items():
-        content_lower = content.lower()
-        matches = [m.start() for m in re.finditer(re.escape(query_lower), content_lower)]
-        if matches:
-            match_list = []
-            for m in matches:
-                snippet_start = max(0, m - 30)
-                snippet_end = min(len(content), m + 30)
-                snippet_text = content[snippet_start:snippet_end].replace("\n", " ")
-                # Mark up the snippet
-                snippet_text_display = re.sub(
-                    re.escape(query),
-                    lambda x: f"<mark>{x.group(0)}</mark>",
-                    snippet_text,
-                    flags=re.IGNORECASE
-                )
-                match_list.append({
-                    "snippet": snippet_text_display,
-                    "start": m,
-                    "length": len(query)
-                })
-            # Ensure the path is properly formatted with forward slashes
-            normalized_path = path.replace(os.sep, '/')
-            results.append({
-                "path": normalized_path,
-                "matches": match_list
-            })
-    return results
+    workers = max(1, READ_WORKERS)
+    window = workers * 4
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="observe-read") as pool:
+        for full_path in full_paths:
+            pending.append(pool.submit(get_file_content, full_path))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 def strip_md_extension(filename):
     """
@@ -2669,6 +3061,60 @@ def strip_md_extension(filename):
         return filename[:-3]
     return filename
 
+FRONTMATTER_PATTERN = re.compile(r'\A---[ \t]*\r?\n(.*?)\r?\n---[ \t]*(?:\r?\n|\Z)', re.DOTALL)
+
+def frontmatter_value(value):
+    """
+    Convert a scalar frontmatter value: quotes are stripped, true/false become
+    booleans and numbers become int/float; anything else stays a string.
+    """
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in "'\"":
+        return value[1:-1]
+    if value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+def parse_frontmatter(content):
+    """
+    Parse the YAML frontmatter block at the top of a note into a dict.
+    Only the flat subset notes use is understood: 'key: value', inline lists
+    ('key: [a, b]') and block lists ('- item' lines under 'key:').
+    Returns {} when the note has no frontmatter.
+    """
+    match = FRONTMATTER_PATTERN.match(content)
+    if not match:
+        return {}
+    data = {}
+    key = None
+    for line in match.group(1).splitlines():
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#'):
+            continue
+        if stripped == '-' or stripped.startswith('- '):
+            if key is not None:
+                if data.get(key) is None:
+                    data[key] = []
+                if isinstance(data[key], list):
+                    data[key].append(frontmatter_value(stripped[1:].strip()))
+            continue
+        if line[0].isspace() or ':' not in stripped:
+            continue  # Nested mappings are not supported
+        key, _, value = stripped.partition(':')
+        key = key.strip()
+        value = value.strip()
+        if value.startswith('[') and value.endswith(']'):
+            data[key] = [frontmatter_value(v.strip()) for v in value[1:-1].split(',') if v.strip()]
+        else:
+            data[key] = frontmatter_value(value) if value else None
+    return data
+
 def ensure_directory_exists(directory_path):
     """
     Ensure that a directory exists, creating it if necessary.
@@ -2699,18 +3145,122 @@ def get_file_content(file_path):
 
 def save_file_content(file_path, content):
     """
-    Save content to a file, with error handling.
+    Save content to a file atomically, with error handling.
+    The content is written to a temporary file in the same directory, fsynced
+    and then moved over the target with os.replace, so a crash mid-write never
+    leaves a truncated note behind.
     """
+    tmp_path = None
     try:
         # Ensure the directory exists
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        
-        with open(file_path, 'w', encoding='utf-8') as f:
+        directory = os.path.dirname(file_path)
+        os.makedirs(directory, exist_ok=True)
+
+        # Keep the permissions of the file being replaced
+        try:
+            mode = os.stat(file_path).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o644
+
+        # Dot-prefixed so a concurrent scan skips it
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(file_path)}.", suffix=".tmp")
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
             f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, file_path)
+        tmp_path = None
+        fsync_directory(directory)
         return True
     except Exception as e:
         print(f"Error writing to {file_path}: {e}")
         return False
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def fsync_directory(directory):
+    """
+    Flush a directory entry change (e.g. a rename) to disk where supported.
+    """
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return  # Not supported on this platform (e.g. Windows)
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+def content_version(content):
+    """
+    Return a short version tag for a note's content (a SHA-1 of its text).
+    """
+    return hashlib.sha1(content.encode("utf-8", "surrogatepass")).hexdigest()
+
+def apply_text_patches(content, patches):
+    """
+    Apply a list of {start, end, text} splices to 'content' and return the result.
+    Offsets are UTF-16 code units (JavaScript string indices) into the base
+    content, and patches must not overlap. Raises ValueError for malformed or
+    out-of-range patches.
+    """
+    units = content.encode("utf-16-le", "surrogatepass")
+    length = len(units) // 2
+    parts = []
+    pos = 0
+    try:
+        patches = sorted(patches, key=lambda p: int(p["start"]))
+        for patch in patches:
+            start, end, text = int(patch["start"]), int(patch["end"]), patch.get("text", "")
+            if not isinstance(text, str) or not pos <= start <= end <= length:
+                raise ValueError("Patch is out of range or overlaps another patch.")
+            parts.append(units[pos * 2:start * 2])
+            parts.append(text.encode("utf-16-le", "surrogatepass"))
+            pos = end
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Malformed patch: {e}")
+    parts.append(units[pos * 2:])
+    result = b"".join(parts).decode("utf-16-le", "surrogatepass")
+    # Reject splices that cut a surrogate pair in half
+    result.encode("utf-8")
+    return result
+
+def read_current_content(rel_path, full_path):
+    """
+    Return the latest content of a note: an autosave still queued for
+    write-behind, else the file on disk. Disk is the source of truth shared by
+    all workers, so a stale cache entry is refreshed. Returns None if unreadable.
+    """
+    content = write_queue.get(full_path)
+    if content is not None:
+        return content
+    content = get_file_content(full_path)
+    if content is not None and file_cache.peek(rel_path) != content:
+        update_cached_note(rel_path, content)
+    return content
+
+def check_if_match(rel_path, full_path):
+    """
+    Enforce the request's If-Match header (if any) against the note's current
+    content version. Returns a 412 error response if the client's version is
+    stale, or None if the mutation may proceed.
+    Call with note_lock held so the check and the write are not interleaved.
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    content = read_current_content(rel_path, full_path)
+    version = content_version(content) if content is not None else None
+    if version is None or not request.if_match.contains(version):
+        return jsonify({
+            "error": "File has changed since it was loaded.",
+            "conflict": True,
+            "version": version
+        }), 412
+    return None
 
 def acquire_file_lock(file_path, user_id, timeout=300):
     """
@@ -2758,327 +3308,2392 @@ def release_file_lock(file_path, lock_id):
 def refresh_file_cache():
     """
     Refresh the file cache to reflect changes.
+    With lazy_load enabled the search index is filled by a background prefetch.
     """
-    global file_cache, file_tree
-    file_cache = cache_files(CONTENT_ROOT)
-    file_tree = build_file_tree(CONTENT_ROOT)
+    global file_cache, file_tree, vault_dirs, search_index, link_index, name_index, meta_index, outline_index, link_report
+    file_tree, notes, vault_dirs = scan_vault(CONTENT_ROOT)
+    file_cache = cache_files(CONTENT_ROOT, notes)
+    if LAZY_LOAD:
+        search_index, link_index, name_index, meta_index, outline_index = new_note_indexes(file_cache)
+        search_index.complete = False
+        link_report = LinkReport(link_index)
+        link_report.mark(file_cache.keys())
+        threading.Thread(
+            target=prefetch_file_cache,
+            args=(file_cache,),
+            name="observe-prefetch",
+            daemon=True,
+        ).start()
+    else:
+        search_index, link_index, name_index, meta_index, outline_index = build_note_indexes(file_cache)
+        link_report = LinkReport(link_index)
+        link_report.mark(file_cache.keys())
+    invalidate_rendered_links()
 
-# -------------------------------------------------------------------
-# Precompute the file tree and content cache on startup
-# -------------------------------------------------------------------
-@app.before_first_request
-def init_data():
-    global file_tree, file_cache
-    file_tree = build_file_tree(CONTENT_ROOT)
-    file_cache = cache_files(CONTENT_ROOT)
+def write_note(rel_path, full_path, content, auto_save=False):
+    """
+    Persist an edited note and update it in the cache.
+    With write_behind enabled, autosaves are acknowledged immediately and
+    queued; everything else is written synchronously. Returns True on success.
+    """
+    if WRITE_BEHIND and auto_save:
+        # The queue coalesces autosaves into one write
+        write_queue.enqueue(full_path, content)
+    elif not write_queue.write(full_path, content):
+        return False
+    update_cached_note(rel_path, content)
+    return True
 
-@app.route("/")
-def index():
+def update_cached_note(rel_path, content):
     """
-    Serve a Bootstrap-based page that calls our API endpoints
-    and displays a professional-looking interface.
-    - File list hides '.md'
-    - Search results are collapsible
-    - Clicking a search result highlights the match
-    - Title is added above each rendered document, with an extra <br> after
-    - The Clear button has no text, uses the same styling as the search button,
-      and is placed next to the search button.
+    Update a single note in the content cache and search index in place,
+    instead of rescanning the whole vault.
     """
-    return render_template_string(html_template, page_title=PAGE_TITLE, editor_theme=EDITOR_THEME, auto_save_interval=AUTO_SAVE_INTERVAL)
+    if rel_path not in file_cache:
+        invalidate_rendered_links()
+    old_content = file_cache.peek(rel_path)
+    file_cache[rel_path] = content
+    index_note(rel_path, content, old_content)
 
-@app.route("/view/<path:file_path>")
-def view_file(file_path):
+def remove_cached_note(rel_path):
     """
-    Serve the main page but with a specific file loaded.
-    The JavaScript will detect the path and load the file.
+    Drop a single note from the content cache and search index.
     """
-    try:
-        logger.debug(f"View file request for path: {file_path}")
-        
-        # Verify if the file exists - this helps us fail early with a better error message
-        full_path = os.path.join(CONTENT_ROOT, file_path)
-        if not is_safe_path(full_path):
-            logger.error(f"Unsafe path attempted: {full_path}")
-            return "Invalid file path", 400
-            
-        if not os.path.exists(full_path):
-            logger.error(f"File not found: {full_path}")
-            return "File not found", 404
-            
-        # File exists, render the template
-        return render_template_string(html_template, page_title=PAGE_TITLE, editor_theme=EDITOR_THEME, auto_save_interval=AUTO_SAVE_INTERVAL)
-    except Exception as e:
-        logger.error(f"Error in view_file: {str(e)}")
-        return f"Server error: {str(e)}", 500
+    if rel_path in file_cache:
+        invalidate_rendered_links()
+    unindex_note(rel_path, file_cache.pop(rel_path, None))
 
-@app.route("/api/tree")
-def api_tree():
+def invalidate_rendered_links():
     """
-    Return the directory tree as JSON.
+    Mark cached renders as stale: they resolved links against a set of
+    notes, names or directories that has since changed.
     """
-    return jsonify(file_tree)
+    global render_generation
+    render_generation += 1
 
-@app.route("/api/file")
-def api_file():
+def move_cached_notes(old_rel_path, new_rel_path):
     """
-    Return the rendered HTML of a specific .md file with:
-    - Properly formatted tables with Bootstrap styling
-    - Single newlines converted to <br>
-    - Improved spacing and grid layout
-    - Correctly rendered numbered lists
+    Re-key the cached notes of a moved file or directory in place.
     """
-    try:
-        rel_path = request.args.get("path", "")
-        rel_path = rel_path.replace('/', os.sep)
-        logger.debug(f"API file request for path: {rel_path}")
-        
-        if not rel_path:
-            return jsonify({"error": "No file path specified."})
+    prefix = old_rel_path.rstrip(os.sep) + os.sep
+    for path in file_cache.keys():
+        if path != old_rel_path and not path.startswith(prefix):
+            continue
+        new_path = new_rel_path + path[len(old_rel_path):]
+        content = file_cache.peek(path)
+        remove_cached_note(path)
+        if content is not None and is_cacheable_note(new_path):
+            update_cached_note(new_path, content)
+
+def moved_path(path, old_rel_path, new_rel_path):
+    """
+    Return where 'path' ends up when 'old_rel_path' (a file or directory) is
+    moved to 'new_rel_path', or None if it is not affected by the move.
+    """
+    if path == old_rel_path or path.startswith(old_rel_path.rstrip(os.sep) + os.sep):
+        return new_rel_path + path[len(old_rel_path):]
+    return None
 
-        full_path = os.path.join(CONTENT_ROOT, rel_path)
-        logger.debug(f"Full path: {full_path}")
-        
-        if not is_safe_path(full_path):
-            logger.error(f"Invalid path attempted: {full_path}")
-            return jsonify({"error": "Invalid path."})
+def rewrite_note_links(source_rel_path, content, old_rel_path, new_rel_path):
+    """
+    Return 'content' with its links updated for a move of 'old_rel_path' to
+    'new_rel_path': relative markdown links are re-pointed (from the note's own
+    new location if it moved too) and [[wiki-links]] naming a moved note by
+    its file name or partial path are renamed. Titles, #headings, '|aliases'
+    and whether a link carried '.md' are kept; fenced code is left alone.
+    """
+    new_source = moved_path(source_rel_path, old_rel_path, new_rel_path) or source_rel_path
+
+    def markdown_link(match):
+        url = match.group(2)
+        target = resolve_relative_link(source_rel_path, url.strip())
+        if target is None:
+            return match.group(0)
+        path_part = url.split(' "', 1)[0].split('#', 1)[0].rstrip()
+        had_md = unquote(path_part).lower().endswith('.md')
+        new_target = moved_path(target, old_rel_path, new_rel_path)
+        if new_target is None and not had_md:
+            # A link to a directory ('[Sub](Docs/Sub)')
+            new_target = moved_path(strip_md_extension(target), old_rel_path, new_rel_path)
+            if new_target is not None:
+                new_target += '.md'
+        if new_target is None:
+            if new_source == source_rel_path:
+                return match.group(0)
+            new_target = target
+        new_url = os.path.relpath(new_target, os.path.dirname(new_source) or os.curdir).replace(os.sep, '/')
+        if not had_md:
+            new_url = strip_md_extension(new_url)
+        if '%' in path_part:
+            new_url = quote(new_url)
+        if new_url == path_part:
+            return match.group(0)
+        return f'[{match.group(1)}]({new_url}{url[len(path_part):]})'
+
+    def wiki_link(match):
+        inner = match.group(1)
+        name = re.split(r'[|#^]', inner, 1)[0]
+        key = wiki_link_key(name)
+        resolved = name_index.resolve(key)
+        if resolved is None or key not in note_name_keys(resolved):
+            return match.group(0)  # Unresolved, or linked through an alias
+        new_path = moved_path(resolved, old_rel_path, new_rel_path)
+        if new_path is None:
+            return match.group(0)
+        # Keep the same number of path parts, adding more if the short name
+        # would now resolve to a different (shallower) note
+        parts = strip_md_extension(new_path).split(os.sep)
+        rank = (new_path.count(os.sep), new_path.lower())
+        depth = key.count('/') + 1
+        while depth < len(parts):
+            others = name_index.by_path_name.get('/'.join(parts[-depth:]).lower(), ())
+            if all(moved_path(p, old_rel_path, new_rel_path) or (p.count(os.sep), p.lower()) > rank for p in others):
+                break
+            depth += 1
+        new_name = '/'.join(parts[-depth:])
+        if name.strip().lower().endswith('.md'):
+            new_name += '.md'
+        return f'[[{new_name}{inner[len(name):]}]]'
+
+    # Rewrite outside fenced code blocks only
+    pieces = []
+    last = 0
+    for block in list(FENCED_BLOCK_PATTERN.finditer(content)) + [None]:
+        end = block.start() if block else len(content)
+        text = MARKDOWN_LINK_PATTERN.sub(markdown_link, content[last:end])
+        pieces.append(WIKI_LINK_PATTERN.sub(wiki_link, text))
+        if block:
+            pieces.append(block.group(0))
+            last = block.end()
+    return ''.join(pieces)
+
+def move_vault_path(rel_path, full_path, new_rel_path, new_full_path):
+    """
+    Move a note or directory and keep every link to it working.
+    The notes to rewrite are found through the link index (backlinks of the
+    moved notes, plus moved notes whose relative links change) rather than by
+    reading the vault. After the rename their new contents are written
+    atomically in one pass, and the cache and indexes are updated in place.
+    Returns the (new) paths of the notes whose links were rewritten.
+    Call with note_lock held.
+    """
+    moved_notes = [path for path in file_cache.keys() if moved_path(path, rel_path, new_rel_path)]
+    sources = set(link_index.by_path.get(rel_path.rstrip(os.sep) + '.md', ()))
+    for path in moved_notes:
+        sources |= link_index.backlinks(path)
+        new_dir = os.path.dirname(moved_path(path, rel_path, new_rel_path))
+        for kind, target in link_index.outgoing.get(path, ()):
+            if kind == "path" and not moved_path(target, rel_path, new_rel_path) and \
+                    os.path.relpath(target, new_dir or os.curdir) != os.path.relpath(target, os.path.dirname(path) or os.curdir):
+                sources.add(path)
+                break
+
+    rewrites = []
+    for source in sorted(sources):
+        content = read_current_content(source, os.path.join(CONTENT_ROOT, source))
+        if content is None:
+            continue
+        new_content = rewrite_note_links(source, content, rel_path, new_rel_path)
+        if new_content != content:
+            rewrites.append((moved_path(source, rel_path, new_rel_path) or source, new_content))
+
+    write_queue.flush(full_path)
+    os.rename(full_path, new_full_path)
+    move_cached_notes(rel_path, new_rel_path)
+
+    rewritten = []
+    for source, content in rewrites:
+        if write_queue.write(os.path.join(CONTENT_ROOT, source), content):
+            update_cached_note(source, content)
+            rewritten.append(source)
+        else:
+            logger.error(f"Failed to update links in '{source}' after moving '{rel_path}'")
+    return rewritten
+
+def is_cacheable_note(rel_path):
+    """
+    Return True if a path names a note that belongs in the content cache.
+    """
+    name = os.path.basename(rel_path)
+    parts = rel_path.split(os.sep)
+    return name.lower().endswith(".md") and not name.startswith(".") and ".obsidian" not in parts
 
-        # Check directly if file exists on disk
-        if not os.path.exists(full_path):
-            logger.error(f"File not found on disk: {full_path}")
-            return jsonify({"error": f"File '{rel_path}' not found on disk."})
+def resolve_view_link(rel_path, link_url):
+    """
+    Rewrite a markdown link found in the note 'rel_path' to a /view/ URL,
+    keeping its #fragment and title. Returns (link_url, exists); external
+    links, anchors and attachments are returned unchanged and count as
+    existing. The target is resolved like /api/links does, and existence is
+    checked against file_cache and vault_dirs only, never the filesystem.
+    """
+    target = resolve_relative_link(rel_path, link_url)
+    if target is None:
+        return link_url, True
+    link_url, quote_mark, title = link_url.partition(' "')
+    fragment = link_url.strip().strip('<>').partition('#')[2]
+    if target not in file_cache and strip_md_extension(target) in vault_dirs:
+        target = strip_md_extension(target)
+    view_url = f'/view/{quote(target.replace(os.sep, "/"))}'
+    if fragment:
+        view_url += f'#{fragment}'
+    if quote_mark:
+        view_url += f'{quote_mark}{title}'
+    return view_url, target in file_cache or target in vault_dirs
+
+def rebuild_file_tree():
+    """
+    Rebuild only the sidebar tree (no file contents are read).
+    """
+    global file_tree, vault_dirs
+    file_tree, _, vault_dirs = scan_vault(CONTENT_ROOT)
+    invalidate_rendered_links()
 
-        # Check if in cache, refresh cache if not found
-        if rel_path not in file_cache:
-            logger.info(f"File not found in cache, refreshing cache: {rel_path}")
-            refresh_file_cache()
-            
-            # Check again after refresh
-            if rel_path not in file_cache:
-                logger.error(f"File still not found in cache after refresh: {rel_path}")
-                
-                # Try to read directly from disk as fallback
-                try:
-                    with open(full_path, "r", encoding="utf-8") as f:
-                        content = f.read()
-                        # Add to cache
-                        file_cache[rel_path] = content
-                        logger.info(f"Successfully loaded file from disk: {rel_path}")
-                except Exception as e:
-                    logger.error(f"Error reading file from disk: {str(e)}")
-                    return jsonify({"error": f"File '{rel_path}' could not be read: {str(e)}"})
-            
-        content = file_cache[rel_path]
+# -------------------------------------------------------------------
+# Search index and query language
+# -------------------------------------------------------------------
+# Inline tags such as #project or #project/alpha (not headings, anchors or entities)
+TAG_PATTERN = re.compile(r'(?<![\w/&#])#([\w/-]*[^\W\d][\w/-]*)')
+FENCED_BLOCK_PATTERN = re.compile(r'^ {0,3}((`)\2{2,}|(~)\3{2,}).*?^ {0,3}\1(?:\2|\3)*[ \t]*$', re.DOTALL | re.MULTILINE)
+FENCE_PATTERN = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+# Inline code spans and in-page link targets ([Jump](#overview)), which hold no tags
+TAG_EXCLUDED_PATTERN = re.compile(r'(?<!`)(`+)(?!`).+?(?<!`)\1(?!`)|\]\(#[^)]*\)', re.DOTALL)
+QUERY_TOKEN_PATTERN = re.compile(r'\s*(?:(\()|(\))|(-)?(?:(path|tag|title):)?(?:"([^"]*)"?|([^\s()"]+)))', re.IGNORECASE)
+QUERY_OPERATORS = {"AND", "OR", "NOT"}
+SNIPPET_RADIUS = 30
+
+
+def extract_tags(content):
+    """
+    Return the set of lowercase tags of a note: inline #tags (ignoring code
+    and link targets) plus the 'tags' (or 'tag') listed in its frontmatter.
+    """
+    meta = parse_frontmatter(content)
+    declared = meta.get("tags", meta.get("tag")) or []
+    if not isinstance(declared, list):
+        declared = re.split(r'[,\s]+', str(declared))
+    tags = {str(tag).strip().lstrip("#").strip("/").lower() for tag in declared}
+    if "#" in content:
+        content = FENCED_BLOCK_PATTERN.sub("", FRONTMATTER_PATTERN.sub("", content, 1))
+        content = TAG_EXCLUDED_PATTERN.sub(" ", content)
+        tags.update(m.group(1).strip("/").lower() for m in TAG_PATTERN.finditer(content))
+    tags.discard("")
+    return tags
+
+
+def note_title(rel_path):
+    """
+    Return the display title of a note: its file name minus .md.
+    """
+    return strip_md_extension(os.path.basename(rel_path))
 
-        # Normalize newlines to Unix-style
-        content = content.replace("\r\n", "\n").replace("\r", "\n")
 
-        # Special handling for mermaid diagrams - FIRST, before any other code block processing
-        mermaid_blocks = {}
-        mermaid_pattern = r'```mermaid\s*\n(.*?)\n\s*```'
-        
-        def save_mermaid_block(match):
-            mermaid_content = match.group(1)
-            placeholder = f'MERMAID_PLACEHOLDER_{len(mermaid_blocks)}'
-            mermaid_blocks[placeholder] = mermaid_content
-            return placeholder
-        
-        content = re.sub(mermaid_pattern, save_mermaid_block, content, flags=re.DOTALL)
+def trigrams(text):
+    """
+    Return the set of 3-character substrings of 'text'.
+    """
+    return {text[i:i + 3] for i in range(len(text) - 2)}
 
-        # Pre-process other code blocks after mermaid blocks are extracted
-        code_blocks = {}
-        code_block_pattern = r'```(\w*)\s*\n(.*?)\n\s*```'
-        
-        def save_code_block(match):
-            lang = match.group(1) or ''
-            code = match.group(2)
-            placeholder = f'CODE_BLOCK_PLACEHOLDER_{len(code_blocks)}'
-            code_blocks[placeholder] = (lang, code)
-            return placeholder
-        
-        content = re.sub(code_block_pattern, save_code_block, content, flags=re.DOTALL)
-
-        # Pre-process pipe tables - convert Markdown pipe tables to HTML tables
-        pipe_table_pattern = r'^\|(.+)\|\s*$\n^\|[-:\|\s]+\|\s*$\n((?:^\|.+\|\s*$\n)+)'
-        
-        def convert_pipe_table_to_html(match):
-            header_row = match.group(1).strip()
-            header_cells = [cell.strip() for cell in header_row.split('|') if cell.strip()]
-            
-            content_rows = match.group(2).strip().split('\n')
-            rows_html = []
-            
-            # Create header HTML
-            header_html = '<tr>\n' + ''.join([f'<th>{cell}</th>\n' for cell in header_cells]) + '</tr>'
-            
-            # Process content rows
-            for row in content_rows:
-                cells = [cell.strip() for cell in row.split('|')[1:-1]]  # Skip first and last empty cells
-                row_html = '<tr>\n' + ''.join([f'<td>{cell}</td>\n' for cell in cells]) + '</tr>'
-                rows_html.append(row_html)
-            
-            # Combine into final table HTML
-            table_html = f'<table>\n<thead>\n{header_html}\n</thead>\n<tbody>\n{"".join(rows_html)}\n</tbody>\n</table>'
-            return table_html
-        
-        # Process relative links BEFORE markdown conversion
-        def process_relative_links_md(match):
-            link_text = match.group(1)
-            link_url = match.group(2)
-            
-            # If it's a relative link (not starting with http://, https://, or #)
-            if not (link_url.startswith('http://') or link_url.startswith('https://') or link_url.startswith('#')):
-                # Get the directory of the current file
-                current_dir = os.path.dirname(rel_path)
-                # Construct the full path relative to the current file
-                full_link_path = os.path.normpath(os.path.join(current_dir, link_url))
-                # Convert back to URL format
-                link_url = full_link_path.replace(os.sep, '/')
-                # Add .md extension if not present and not a directory
-                if not os.path.isdir(os.path.join(CONTENT_ROOT, full_link_path)) and not link_url.endswith('.md'):
-                    link_url += '.md'
-                # Convert to a URL that the app can handle
-                link_url = f'/view/{link_url}'
-            
-            return f'[{link_text}]({link_url})'
-
-        # Process markdown links before conversion
-        content = re.sub(
-            r'\[([^\]]+)\]\(([^)]+)\)',
-            process_relative_links_md,
-            content
-        )
 
-        # Apply the pipe table conversion before markdown processing
-        content = re.sub(pipe_table_pattern, convert_pipe_table_to_html, content, flags=re.MULTILINE)
-
-        # Convert Markdown to HTML with correct list rendering
-        html_content = markdown.markdown(
-            content,
-            extensions=[
-                "fenced_code",      # Handle code blocks FIRST
-                "codehilite",       # Syntax highlighting for code blocks
-                "tables",           # Then process tables
-                "extra",            # Adds support for footnotes, abbreviations, etc.
-                "sane_lists",       # Fixes numbered list rendering
-                "attr_list",        # Adds support for attributes in lists
-                "def_list",         # Definition lists
-                "md_in_html",       # Markdown inside HTML
-                "nl2br",            # Convert newlines to <br> AFTER table processing
-            ],
-        )
+class SearchIndex:
+    """
+    Inverted index over the cached notes.
+    Note content is indexed by lowercase trigrams so that any substring or phrase
+    can be narrowed to a small candidate set by intersecting posting lists, and
+    only those candidates are verified against the text. Tags are kept in their
+    own posting lists for tag: filters.
+    Each posting list is a sorted array of 4-byte note ids. Every (re)indexed
+    note gets a fresh, larger id, so appending keeps the arrays sorted and ids
+    of removed notes can simply be skipped until the next compaction. Notes
+    that would push the estimated size past 'memory_limit' bytes are not
+    trigram-indexed; they are always candidates and verified by scanning.
+    """
 
-        # Restore code blocks
-        for placeholder, (lang, code) in code_blocks.items():
-            lang_attr = f' class="language-{lang}"' if lang else ''
-            escaped_code = html.escape(code)
-            code_html = f'<div class="codehilite"><pre><code{lang_attr}>{escaped_code}</code></pre></div>'
-            html_content = html_content.replace(placeholder, code_html)
-
-        # Restore mermaid blocks
-        for placeholder, mermaid_content in mermaid_blocks.items():
-            html_content = html_content.replace(placeholder, f'<div class="mermaid">{mermaid_content}</div>')
-
-        # Process language-specific code blocks that might not have been correctly processed
-        # This handles cases where ```python or ```cpp blocks might not render correctly
-        html_content = re.sub(
-            r'<p>```(\w+)\s*(.*?)\s*```</p>',
-            lambda m: f'<div class="codehilite"><pre><code class="language-{m.group(1)}">{html.escape(m.group(2))}</code></pre></div>',
-            html_content,
-            flags=re.DOTALL
-        )
-        
-        # Also handle plain fenced code blocks without language identifier
-        html_content = re.sub(
-            r'<p>```\s*(.*?)\s*```</p>',
-            lambda m: f'<div class="codehilite"><pre><code>{html.escape(m.group(1))}</code></pre></div>',
-            html_content,
-            flags=re.DOTALL
-        )
+    GRAM_OVERHEAD = 240  # approximate bytes per distinct trigram (key, dict slot, array header)
+
+    def __init__(self, memory_limit=None):
+        self.memory_limit = memory_limit
+        self.postings = {}      # trigram -> array('I') of note ids, ascending
+        self.tag_postings = {}  # tag -> set of paths
+        self.docs = {}          # path -> (id, trigram count); id is None when not trigram-indexed
+        self.doc_paths = {}     # id -> path, for live notes only
+        self.doc_tags = {}      # path -> tags
+        self.unindexed = set()  # paths over the memory budget, verified by scanning
+        self.next_id = 0
+        self.entries = 0        # live posting entries
+        self.stale = 0          # posting entries of removed notes not yet compacted
+        self.complete = True    # False while lazy_load prefetch is still indexing
+        self.lock = threading.Lock()
+
+    def add(self, rel_path, content, old_content=None):
+        """
+        Index (or re-index) a single note. 'old_content', when known, is the
+        text it was previously indexed with, so its postings can be removed.
+        """
+        grams = trigrams(content.lower())
+        old_grams = trigrams(old_content.lower()) if old_content is not None else ()
+        tags = extract_tags(content)
+        with self.lock:
+            self._remove(rel_path, old_grams)
+            for tag in tags:
+                self.tag_postings.setdefault(tag, set()).add(rel_path)
+            self.doc_tags[rel_path] = tags
+            if self.memory_limit and not self._fits(grams):
+                self._compact()
+                if not self._fits(grams):
+                    self.docs[rel_path] = (None, 0)
+                    self.unindexed.add(rel_path)
+                    return
+            doc_id = self.next_id
+            self.next_id += 1
+            for gram in grams:
+                ids = self.postings.get(gram)
+                if ids is None:
+                    ids = self.postings[sys.intern(gram)] = array("I")
+                ids.append(doc_id)
+            self.docs[rel_path] = (doc_id, len(grams))
+            self.doc_paths[doc_id] = rel_path
+            self.entries += len(grams)
+
+    def remove(self, rel_path, old_content=None):
+        """
+        Drop a note from the index.
+        """
+        old_grams = trigrams(old_content.lower()) if old_content is not None else ()
+        with self.lock:
+            self._remove(rel_path, old_grams)
+
+    def _remove(self, rel_path, old_grams):
+        doc_id, count = self.docs.pop(rel_path, (None, 0))
+        self.unindexed.discard(rel_path)
+        if doc_id is not None:
+            del self.doc_paths[doc_id]
+            self.entries -= count
+            self.stale += count
+            for gram in old_grams:
+                ids = self.postings.get(gram)
+                if ids is None:
+                    continue
+                i = bisect.bisect_left(ids, doc_id)
+                if i < len(ids) and ids[i] == doc_id:
+                    del ids[i]
+                    self.stale -= 1
+                    if not ids:
+                        del self.postings[gram]
+        for tag in self.doc_tags.pop(rel_path, ()):
+            paths = self.tag_postings.get(tag)
+            if paths is not None:
+                paths.discard(rel_path)
+                if not paths:
+                    del self.tag_postings[tag]
+        if self.stale > max(self.entries, 65536):
+            self._compact()
+
+    def _size(self, grams=()):
+        """
+        Estimated bytes held by the trigram postings, after adding 'grams'.
+        """
+        new = sum(1 for gram in grams if gram not in self.postings)
+        return (len(self.postings) + new) * self.GRAM_OVERHEAD + (self.entries + self.stale + len(grams)) * 4
+
+    def _fits(self, grams):
+        """
+        Whether adding 'grams' stays within memory_limit. New trigrams are
+        only counted exactly when the quick upper bound does not fit.
+        """
+        if self._size() + len(grams) * (self.GRAM_OVERHEAD + 4) <= self.memory_limit:
+            return True
+        return self._size(grams) <= self.memory_limit
+
+    def _compact(self):
+        """
+        Drop the ids of removed notes left behind in the posting lists.
+        """
+        if not self.stale:
+            return
+        live = self.doc_paths
+        for gram in list(self.postings):
+            ids = array("I", (doc_id for doc_id in self.postings[gram] if doc_id in live))
+            if ids:
+                self.postings[gram] = ids
+            else:
+                del self.postings[gram]
+        self.stale = 0
+
+    def paths(self):
+        return set(self.docs)
+
+    def posting_count(self, gram):
+        """
+        Upper bound on the notes containing 'gram', for query planning.
+        """
+        return len(self.postings.get(gram, ())) + len(self.unindexed)
+
+    def candidates(self, term):
+        """
+        Return the notes whose trigrams cover every trigram of 'term'.
+        Terms shorter than three characters cannot be narrowed and match every note.
+        """
+        grams = trigrams(term)
+        with self.lock:
+            if not grams:
+                return set(self.docs)
+            lists = sorted((self.postings.get(gram, ()) for gram in grams), key=len)
+            ids = set(lists[0])
+            for other in lists[1:]:
+                if not ids:
+                    break
+                ids.intersection_update(other)
+            result = {self.doc_paths[doc_id] for doc_id in ids if doc_id in self.doc_paths}
+            return result | self.unindexed
+
+    def tagged(self, tag):
+        """
+        Return the notes carrying 'tag' or any tag nested below it.
+        """
+        tag = tag.lstrip("#").strip("/").lower()
+        prefix = tag + "/"
+        with self.lock:
+            result = set(self.tag_postings.get(tag, ()))
+            for name, paths in self.tag_postings.items():
+                if name.startswith(prefix):
+                    result |= paths
+        return result
+
+    def tag_counts(self):
+        """
+        Return {tag: (count, total)} for every tag and every parent of a
+        nested tag: 'count' notes carry the tag itself, 'total' carry it or
+        any tag nested below it.
+        """
+        with self.lock:
+            direct = {tag: len(paths) for tag, paths in self.tag_postings.items()}
+            nested = {}
+            for tag, paths in self.tag_postings.items():
+                parts = tag.split("/")
+                for i in range(1, len(parts) + 1):
+                    nested.setdefault("/".join(parts[:i]), set()).update(paths)
+        return {tag: (direct.get(tag, 0), len(paths)) for tag, paths in nested.items()}
+
+
+def new_note_indexes(cache):
+    """
+    Return fresh instances of every per-note index:
+    (search_index, link_index, name_index, meta_index, outline_index).
+    The name index already knows every note path in 'cache', so wiki-links
+    resolve before the note bodies have been read.
+    """
+    names = NameIndex()
+    for rel_path in cache.keys():
+        names.add_path(rel_path)
+    search = SearchIndex(SEARCH_INDEX_MEMORY_MB * 1024 * 1024)
+    return search, LinkIndex(names), names, MetadataIndex(), OutlineIndex()
 
-        # Process wiki-links (avoid processing inside href attributes)
-        html_content = re.sub(
-            r'\[\[(.*?)\]\]',
-            lambda m: f'<a href="#" class="wiki-link">{m.group(1)}</a>',
-            html_content
-        )
+def build_note_indexes(cache):
+    """
+    Build every per-note index from a {rel_path: content} mapping.
+    """
+    indexes = new_note_indexes(cache)
+    for rel_path, content in cache.items():
+        for index in indexes:
+            index.add(rel_path, content)
+    return indexes
 
-        # First extract all href attributes to protect them from processing
-        href_placeholders = {}
-        href_pattern = r'href="([^"]*)"'
-        
-        def save_href(match):
-            href_content = match.group(1)
-            placeholder = f'HREF_PLACEHOLDER_{len(href_placeholders)}'
-            href_placeholders[placeholder] = href_content
-            return f'href="{placeholder}"'
-        
-        # Replace all href attributes with placeholders
-        html_content = re.sub(href_pattern, save_href, html_content)
-        
-        # Process tags (now safe from href content)
-        html_content = re.sub(
-            r'#(\w+)',
-            lambda m: f'<span class="tag">#{m.group(1)}</span>',
-            html_content
+def index_note(rel_path, content, old_content=None):
+    """
+    Update every per-note index for one note's new content.
+    'old_content' is what the note held before, when it is known.
+    """
+    affected = link_report.affected(rel_path)
+    aliases = name_index.note_aliases.get(rel_path)
+    search_index.add(rel_path, content, old_content)
+    name_index.add(rel_path, content)
+    if name_index.note_aliases.get(rel_path) != aliases:
+        invalidate_rendered_links()
+    meta_index.add(rel_path, content)
+    outline_index.add(rel_path, content)
+    link_index.add(rel_path, content)
+    link_report.mark(affected | link_report.affected(rel_path))
+
+def unindex_note(rel_path, old_content=None):
+    """
+    Drop a note from every per-note index.
+    """
+    affected = link_report.affected(rel_path)
+    search_index.remove(rel_path, old_content)
+    name_index.remove(rel_path)
+    meta_index.remove(rel_path)
+    outline_index.remove(rel_path)
+    link_index.remove(rel_path)
+    link_report.mark(affected)
+
+
+def ensure_indexed():
+    """
+    Index any cached notes the indexes have not seen yet (lazy_load before the
+    prefetch thread has finished), so queries are never partial.
+    """
+    if search_index.complete:
+        return
+    for rel_path in set(file_cache.keys()) - search_index.paths():
+        content = file_cache.peek(rel_path)
+        if content is not None:
+            index_note(rel_path, content)
+
+
+def prefetch_file_cache(cache):
+    """
+    Background worker for lazy_load: read every note body once, index it,
+    and keep it cached while the store has headroom.
+    """
+    start = time.time()
+    for rel_path in cache.keys():
+        if file_cache is not cache:
+            return  # Superseded by a newer refresh
+        if rel_path in search_index.docs:
+            continue
+        content = cache.prefetch(rel_path)
+        if content is not None:
+            index_note(rel_path, content)
+    search_index.complete = True
+    logger.info(f"Prefetched {len(cache)} notes in {time.time() - start:.2f}s")
+
+
+def tokenize_query(query):
+    """
+    Split a query string into tokens: '(' / ')', the operators AND/OR/NOT,
+    and term tuples of (field, value, negated, quoted).
+    """
+    tokens = []
+    pos = 0
+    while pos < len(query):
+        match = QUERY_TOKEN_PATTERN.match(query, pos)
+        if not match or match.end() == pos:
+            break
+        pos = match.end()
+        lparen, rparen, negated, field, phrase, word = match.groups()
+        if lparen:
+            tokens.append("(")
+        elif rparen:
+            tokens.append(")")
+        elif phrase is None and not field and not negated and word in QUERY_OPERATORS:
+            tokens.append(word)
+        elif phrase is not None or word:
+            value = phrase if phrase is not None else word
+            if value:
+                tokens.append((field.lower() if field else None, value, bool(negated), phrase is not None))
+    return tokens
+
+
+def parse_query(query):
+    """
+    Parse a search query into a small expression tree.
+
+    Grammar (operators are upper-case; adjacent terms are implicitly ANDed):
+        expr   := and_expr ("OR" and_expr)*
+        and    := unary (["AND"] unary)*
+        unary  := ("NOT" | "-") unary | "(" expr ")" | term
+        term   := word | "quoted phrase" | path:value | tag:value | title:value
+
+    Nodes are tuples: ("and", [nodes]), ("or", [nodes]), ("not", node),
+    ("text", value) and ("path" | "tag" | "title", value).
+    Unbalanced parentheses and dangling operators are tolerated.
+    """
+    tokens = tokenize_query(query)
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def parse_or():
+        nonlocal pos
+        nodes = [parse_and()]
+        while peek() == "OR":
+            pos += 1
+            nodes.append(parse_and())
+        nodes = [n for n in nodes if n is not None]
+        if not nodes:
+            return None
+        return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+    def parse_and():
+        nonlocal pos
+        nodes = []
+        while peek() not in (None, ")", "OR"):
+            if peek() == "AND":
+                pos += 1
+                continue
+            node = parse_unary()
+            if node is not None:
+                nodes.append(node)
+        if not nodes:
+            return None
+        return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+    def parse_unary():
+        nonlocal pos
+        token = peek()
+        pos += 1
+        if token == "NOT":
+            node = parse_unary() if peek() not in (None, ")", "OR", "AND") else None
+            return ("not", node) if node is not None else None
+        if token == "(":
+            node = parse_or()
+            if peek() == ")":
+                pos += 1
+            return node
+        field, value, negated, _quoted = token
+        node = (field or "text", value)
+        return ("not", node) if negated else node
+
+    tree = parse_or()
+    # Stray closing parentheses end parse_or early; keep consuming the rest
+    while pos < len(tokens):
+        pos += 1
+        rest = parse_or()
+        if rest is not None:
+            tree = rest if tree is None else ("and", [tree, rest])
+    return tree
+
+
+def query_text_terms(node):
+    """
+    Return the positive (non-negated) text terms of a query tree, for snippets.
+    """
+    if node is None or node[0] == "not":
+        return []
+    if node[0] in ("and", "or"):
+        return [term for child in node[1] for term in query_text_terms(child)]
+    if node[0] == "text":
+        return [node[1]]
+    return []
+
+
+def evaluate_query(node, index, cache, within=None, lowered=None):
+    """
+    Evaluate a query tree against the index and return the set of matching paths.
+    'within' restricts evaluation to an already-narrowed candidate set, so AND
+    chains only verify notes that survived the previous operands.
+    """
+    if lowered is None:
+        lowered = {}
+    universe = index.paths() if within is None else within
+    kind = node[0]
+
+    if kind == "and":
+        # Cheap, selective operands first; negations last since they need a universe
+        children = sorted(node[1], key=lambda child: _query_cost(child, index))
+        result = universe
+        for child in children:
+            if not result:
+                break
+            result = evaluate_query(child, index, cache, result, lowered)
+        return result
+
+    if kind == "or":
+        result = set()
+        for child in node[1]:
+            result |= evaluate_query(child, index, cache, universe, lowered)
+        return result
+
+    if kind == "not":
+        return universe - evaluate_query(node[1], index, cache, universe, lowered)
+
+    value = node[1].lower()
+    if kind == "tag":
+        return index.tagged(value) & universe
+    if kind == "path":
+        return {p for p in universe if value in p.replace(os.sep, "/").lower()}
+    if kind == "title":
+        return {p for p in universe if value in note_title(p).lower()}
+
+    # Text term or phrase: narrow via trigram postings, then verify substrings
+    result = set()
+    for rel_path in index.candidates(value) & universe:
+        if rel_path not in lowered:
+            content = cache.peek(rel_path)
+            if content is None:
+                continue
+            lowered[rel_path] = content.lower()
+        if value in lowered[rel_path]:
+            result.add(rel_path)
+    return result
+
+
+def _query_cost(node, index):
+    """
+    Rough selectivity estimate used to order AND operands.
+    """
+    kind = node[0]
+    if kind == "not":
+        return float("inf")
+    if kind in ("and", "or"):
+        return sum(_query_cost(child, index) for child in node[1])
+    if kind == "text":
+        grams = trigrams(node[1].lower())
+        if not grams:
+            return len(index.docs)
+        return min(index.posting_count(gram) for gram in grams)
+    return len(index.docs)
+
+
+def build_snippets(content, terms, rel_path=None):
+    """
+    Build snippet entries for every occurrence of each term in 'content'.
+    Notes matched only by filters get a single leading snippet.
+    With 'rel_path' given, each entry also names its enclosing heading
+    (from outline_index, or None above the first heading).
+    """
+    content_lower = content.lower()
+    match_list = []
+    for term in terms:
+        for m in re.finditer(re.escape(term.lower()), content_lower):
+            start = m.start()
+            snippet_start = max(0, start - SNIPPET_RADIUS)
+            snippet_end = min(len(content), start + SNIPPET_RADIUS)
+            snippet_text = content[snippet_start:snippet_end].replace("\n", " ")
+            # Mark up the snippet
+            snippet_text_display = re.sub(
+                re.escape(term),
+                lambda x: f"<mark>{x.group(0)}</mark>",
+                snippet_text,
+                flags=re.IGNORECASE
+            )
+            match_list.append({
+                "snippet": snippet_text_display,
+                "start": start,
+                "length": len(term)
+            })
+    if not terms:
+        match_list.append({
+            "snippet": content[:SNIPPET_RADIUS * 2].replace("\n", " "),
+            "start": 0,
+            "length": 0
+        })
+    match_list.sort(key=lambda match: match["start"])
+    if rel_path is not None:
+        for match in match_list:
+            heading = outline_index.heading_at(rel_path, match["start"])
+            match["heading"] = heading and {"level": heading[0], "text": heading[1], "slug": heading[2]}
+    return match_list
+
+
+def search_in_files(query, cache):
+    """
+    Search the cached .md files with the query language described in parse_query.
+    Returns a list of { path, matches: [{ snippet, start, length }, ...] }.
+    """
+    tree = parse_query(query)
+    if tree is None:
+        return []
+
+    ensure_indexed()
+
+    paths = evaluate_query(tree, search_index, cache)
+    terms = query_text_terms(tree)
+
+    results = []
+    for path in sorted(paths, key=lambda p: p.lower()):
+        content = cache.peek(path)
+        if content is None:
+            continue
+        # Ensure the path is properly formatted with forward slashes
+        normalized_path = path.replace(os.sep, '/')
+        results.append({
+            "path": normalized_path,
+            "matches": build_snippets(content, terms, path)
+        })
+    return results
+
+# -------------------------------------------------------------------
+# Link graph
+# -------------------------------------------------------------------
+MARKDOWN_LINK_PATTERN = re.compile(r'\[([^\]]+)\]\(([^)]+)\)')
+WIKI_LINK_PATTERN = re.compile(r'\[\[(.*?)\]\]')
+URL_SCHEME_PATTERN = re.compile(r'^[A-Za-z][A-Za-z0-9+.-]*:')
+ATTACHMENT_EXT_PATTERN = re.compile(r'^\.[A-Za-z0-9]{1,5}$')
+
+
+def resolve_relative_link(source_rel_path, link_url):
+    """
+    Resolve a relative markdown link found in 'source_rel_path' to the vault
+    path of the note it points at (os.sep separators, '.md' added like the
+    renderer does). Returns None for external links, anchors, attachments
+    and links that leave the vault.
+    """
+    if link_url.startswith('#') or URL_SCHEME_PATTERN.match(link_url):
+        return None
+    # Drop a link title ([a](b.md "title")) and any #heading
+    link_url = link_url.split(' "', 1)[0].split('#', 1)[0].strip().strip('<>')
+    link_url = unquote(link_url)
+    if not link_url:
+        return None
+    target = os.path.normpath(os.path.join(os.path.dirname(source_rel_path), link_url.replace('/', os.sep)))
+    if target == os.pardir or target.startswith(os.pardir + os.sep):
+        return None
+    ext = os.path.splitext(target)[1]
+    if ext.lower() != '.md':
+        if ATTACHMENT_EXT_PATTERN.match(ext):
+            return None
+        target += '.md'
+    return target
+
+
+def wiki_link_key(target):
+    """
+    Normalize the target of a [[wiki-link]] ('Note', 'Folder/Note.md|alias',
+    'Note#Heading') to a lookup key: lowercase, '/'-separated, no '.md'.
+    """
+    target = re.split(r'[|#^]', target, 1)[0].strip().replace('\\', '/').strip('/')
+    if target.lower().endswith('.md'):
+        target = target[:-3]
+    return target.lower()
+
+
+def note_name_keys(rel_path):
+    """
+    Return the wiki-link keys a note answers to: its name and each trailing
+    part of its path ('deep', 'sub/deep', 'docs/sub/deep' for Docs/Sub/Deep.md).
+    """
+    parts = strip_md_extension(rel_path).replace(os.sep, '/').lower().split('/')
+    return ['/'.join(parts[i:]) for i in range(len(parts))]
+
+
+def extract_links(rel_path, content):
+    """
+    Return the outgoing links of a note as ("path", rel_path) entries for
+    relative markdown links and ("name", key) entries for wiki-links, which
+    are resolved against the current notes at query time. Fenced code is ignored.
+    """
+    content = FENCED_BLOCK_PATTERN.sub("", content)
+    links = []
+    for match in MARKDOWN_LINK_PATTERN.finditer(content):
+        target = resolve_relative_link(rel_path, match.group(2).strip())
+        if target:
+            links.append(("path", target))
+    for match in WIKI_LINK_PATTERN.finditer(content):
+        key = wiki_link_key(match.group(1))
+        if key:
+            links.append(("name", key))
+    return links
+
+
+def note_aliases(content):
+    """
+    Return the 'aliases' (or 'alias') listed in a note's frontmatter.
+    """
+    meta = parse_frontmatter(content)
+    aliases = meta.get("aliases", meta.get("alias"))
+    if aliases is None:
+        return []
+    if not isinstance(aliases, list):
+        aliases = [aliases]
+    return [str(alias) for alias in aliases if str(alias).strip()]
+
+
+class NameIndex:
+    """
+    Resolves [[wiki-link]] targets to note paths with a dictionary lookup.
+    Every note answers to each trailing part of its path (see note_name_keys),
+    case-insensitively and with or without '.md', and to the aliases in its
+    frontmatter. Path names win over aliases; among several notes with the
+    same name the shallowest (then alphabetically first) one is chosen.
+    """
+
+    def __init__(self):
+        self.by_path_name = {}  # key -> set of note paths
+        self.by_alias = {}      # key -> set of note paths
+        self.note_aliases = {}  # note path -> list of alias keys
+        self.lock = threading.RLock()
+
+    def add_path(self, rel_path):
+        """
+        Register a note path (no content needed).
+        """
+        with self.lock:
+            for key in note_name_keys(rel_path):
+                self.by_path_name.setdefault(key, set()).add(rel_path)
+
+    def add(self, rel_path, content):
+        """
+        Register a note path along with the aliases from its frontmatter.
+        """
+        keys = [wiki_link_key(alias) for alias in note_aliases(content)]
+        with self.lock:
+            self.add_path(rel_path)
+            self._remove_aliases(rel_path)
+            keys = [key for key in keys if key]
+            if keys:
+                self.note_aliases[rel_path] = keys
+                for key in keys:
+                    self.by_alias.setdefault(key, set()).add(rel_path)
+
+    def remove(self, rel_path):
+        """
+        Forget a note path and its aliases.
+        """
+        with self.lock:
+            self._remove_aliases(rel_path)
+            for key in note_name_keys(rel_path):
+                self._discard(self.by_path_name, key, rel_path)
+
+    def _remove_aliases(self, rel_path):
+        for key in self.note_aliases.pop(rel_path, ()):
+            self._discard(self.by_alias, key, rel_path)
+
+    @staticmethod
+    def _discard(mapping, key, rel_path):
+        paths = mapping.get(key)
+        if paths is not None:
+            paths.discard(rel_path)
+            if not paths:
+                del mapping[key]
+
+    def keys(self, rel_path):
+        """
+        Return every key a note answers to (path names, then aliases).
+        """
+        with self.lock:
+            return note_name_keys(rel_path) + list(self.note_aliases.get(rel_path, ()))
+
+    def resolve(self, key):
+        """
+        Return the note path a wiki-link key points at, or None.
+        """
+        with self.lock:
+            paths = self.by_path_name.get(key) or self.by_alias.get(key)
+            if not paths:
+                return None
+            return min(paths, key=lambda p: (p.count(os.sep), p.lower()))
+
+
+class LinkIndex:
+    """
+    Link graph between notes.
+    Each note's outgoing links are stored as extracted, with reverse indexes
+    from target path and from wiki-link key back to the linking notes.
+    Wiki-link keys are resolved through 'names' (a NameIndex) at query time,
+    so a link starts resolving as soon as its target note appears. Outgoing
+    links and backlinks of a note are answered in O(degree).
+    """
+
+    def __init__(self, names):
+        self.outgoing = {}   # source path -> list of ("path" | "name", target)
+        self.by_path = {}    # target path -> set of source paths
+        self.by_name = {}    # wiki-link key -> set of source paths
+        self.names = names
+        self.lock = threading.RLock()
+
+    def add(self, rel_path, content):
+        """
+        Index (or re-index) the links of a single note.
+        """
+        links = extract_links(rel_path, content)
+        with self.lock:
+            self._remove_links(rel_path)
+            self.outgoing[rel_path] = links
+            for kind, target in links:
+                reverse = self.by_path if kind == "path" else self.by_name
+                reverse.setdefault(target, set()).add(rel_path)
+
+    def remove(self, rel_path):
+        """
+        Drop a note and its outgoing links from the graph.
+        """
+        with self.lock:
+            self._remove_links(rel_path)
+
+    def _remove_links(self, rel_path):
+        for kind, target in self.outgoing.pop(rel_path, ()):
+            reverse = self.by_path if kind == "path" else self.by_name
+            sources = reverse.get(target)
+            if sources is not None:
+                sources.discard(rel_path)
+                if not sources:
+                    del reverse[target]
+
+    def links(self, rel_path):
+        """
+        Return the resolved outgoing links of a note as a list of
+        (target_path, kind) pairs; unresolved wiki-links keep their key.
+        """
+        with self.lock:
+            result = []
+            for kind, target in self.outgoing.get(rel_path, ()):
+                if kind == "name":
+                    resolved = self.names.resolve(target)
+                    result.append((resolved or target, "wiki"))
+                else:
+                    result.append((target, "markdown"))
+            return result
+
+    def backlinks(self, rel_path):
+        """
+        Return the set of notes linking to 'rel_path'.
+        """
+        with self.lock:
+            sources = set(self.by_path.get(rel_path, ()))
+            for key in self.names.keys(rel_path):
+                if key in self.by_name and self.names.resolve(key) == rel_path:
+                    sources |= self.by_name[key]
+            sources.discard(rel_path)
+            return sources
+
+def link_target_exists(target, kind):
+    """
+    Return whether a link target from LinkIndex.links exists: a cached note,
+    or for markdown links also a vault directory (the renderer links those
+    without the '.md' that resolve_relative_link adds).
+    """
+    if target in file_cache:
+        return True
+    return kind == "markdown" and strip_md_extension(target) in vault_dirs
+
+
+class LinkReport:
+    """
+    Broken links and orphaned (never linked to) notes, derived from a LinkIndex.
+    Writes only mark the notes whose entries may have changed (see affected);
+    a background thread re-checks those against the link index, so keeping
+    the report current never renders or re-reads a note.
+    """
+
+    def __init__(self, links):
+        self.links = links
+        self.broken = {}      # source path -> list of (target, kind) that do not exist
+        self.orphans = set()  # note paths without backlinks
+        self.dirty = set()
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def affected(self, rel_path):
+        """
+        Return the notes whose report entries depend on 'rel_path': the note
+        itself, the notes it links to, the notes linking to it and the notes
+        its names resolve to.
+        """
+        paths = {rel_path}
+        paths.update(target for target, _ in self.links.links(rel_path))
+        paths.update(self.links.backlinks(rel_path))
+        for key in self.links.names.keys(rel_path):
+            resolved = self.links.names.resolve(key)
+            if resolved is not None:
+                paths.add(resolved)
+            paths.update(self.links.by_name.get(key, ()))
+        return paths
+
+    def mark(self, paths):
+        """
+        Queue notes for re-checking, starting the worker if it is idle.
+        """
+        with self.cond:
+            self.dirty.update(paths)
+            if self.thread is None and self.dirty:
+                self.thread = threading.Thread(target=self._run, name="observe-link-report", daemon=True)
+                self.thread.start()
+
+    @property
+    def pending(self):
+        with self.cond:
+            return self.thread is not None
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if not self.dirty:
+                    self.thread = None
+                    return
+                paths, self.dirty = self.dirty, set()
+            for rel_path in paths:
+                self._check(rel_path)
+
+    def _check(self, rel_path):
+        exists = rel_path in file_cache
+        broken = []
+        orphan = False
+        if exists:
+            for target, kind in self.links.links(rel_path):
+                if not link_target_exists(target, kind):
+                    broken.append((target, kind))
+            orphan = not self.links.backlinks(rel_path)
+        with self.cond:
+            if broken:
+                self.broken[rel_path] = broken
+            else:
+                self.broken.pop(rel_path, None)
+            if orphan:
+                self.orphans.add(rel_path)
+            else:
+                self.orphans.discard(rel_path)
+
+    def snapshot(self):
+        """
+        Return (broken, orphans) as copies safe to serialize.
+        """
+        with self.cond:
+            return dict(self.broken), set(self.orphans)
+
+# -------------------------------------------------------------------
+# Frontmatter metadata and queries
+# -------------------------------------------------------------------
+QUERY_FILTER_PATTERN = re.compile(r'^\s*([^=!<>\s]+)\s*(?:(!=|>=|<=|=|>|<)\s*(.*?))?\s*$')
+
+
+def metadata_key(value):
+    """
+    Normalize a frontmatter value for equality lookups.
+    """
+    return str(value).strip().lower()
+
+
+def metadata_sort_key(value):
+    """
+    Order frontmatter values: numbers (and booleans) before text, text
+    case-insensitively. Lists sort by their first item.
+    """
+    if isinstance(value, list):
+        value = value[0] if value else ""
+    if isinstance(value, (int, float)):
+        return (0, value, "")
+    return (1, 0, metadata_key(value))
+
+
+class MetadataIndex:
+    """
+    Parsed frontmatter of every note, extracted once per content change.
+    Besides the per-note metadata, each field keeps the notes that define it
+    and an equality index (normalized value -> notes; every item of a list
+    value is indexed), so /api/query never re-parses a note.
+    """
+
+    def __init__(self):
+        self.meta = {}    # path -> frontmatter dict
+        self.fields = {}  # field -> set of paths defining it
+        self.values = {}  # field -> {normalized value -> set of paths}
+        self.lock = threading.Lock()
+
+    def add(self, rel_path, content):
+        """
+        Index (or re-index) the frontmatter of a single note.
+        """
+        meta = parse_frontmatter(content)
+        with self.lock:
+            self._remove(rel_path)
+            if not meta:
+                return
+            self.meta[rel_path] = meta
+            for field, value in meta.items():
+                field = field.lower()
+                self.fields.setdefault(field, set()).add(rel_path)
+                values = self.values.setdefault(field, {})
+                for item in (value if isinstance(value, list) else [value]):
+                    if item is not None:
+                        values.setdefault(metadata_key(item), set()).add(rel_path)
+
+    def remove(self, rel_path):
+        """
+        Drop a note from the index.
+        """
+        with self.lock:
+            self._remove(rel_path)
+
+    def _remove(self, rel_path):
+        meta = self.meta.pop(rel_path, None)
+        if not meta:
+            return
+        for field, value in meta.items():
+            field = field.lower()
+            paths = self.fields.get(field)
+            if paths is not None:
+                paths.discard(rel_path)
+                if not paths:
+                    del self.fields[field]
+            values = self.values.get(field, {})
+            for item in (value if isinstance(value, list) else [value]):
+                paths = values.get(metadata_key(item))
+                if paths is not None:
+                    paths.discard(rel_path)
+                    if not paths:
+                        del values[metadata_key(item)]
+            if field in self.values and not values:
+                del self.values[field]
+
+    def get(self, rel_path):
+        """
+        Return the frontmatter of a note ({} if it has none).
+        """
+        return self.meta.get(rel_path, {})
+
+    def value(self, rel_path, field):
+        """
+        Return a note's value for a (case-insensitive) field, or None.
+        """
+        for name, value in self.meta.get(rel_path, {}).items():
+            if name.lower() == field:
+                return value
+        return None
+
+    def query(self, filters, sort=None, descending=False):
+        """
+        Return the notes matching every filter, as a list of paths.
+        'filters' are (field, op, value) tuples; op is one of = != > < >= <=,
+        or None to require that the field exists. '=' on a list field matches
+        if any item is equal. Equality and existence filters are answered from
+        the indexes; the remaining filters only check those candidates.
+        Notes are ordered by 'sort' (missing values last), then by path.
+        """
+        with self.lock:
+            candidates = None
+            remaining = []
+            for field, op, value in filters:
+                if op == "=":
+                    paths = self.values.get(field, {}).get(metadata_key(value), set())
+                elif op is None or op != "!=":
+                    paths = self.fields.get(field, set())
+                else:
+                    paths = None
+                if op not in ("=", None):
+                    remaining.append((field, op, value))
+                if paths is not None:
+                    candidates = set(paths) if candidates is None else candidates & paths
+            if candidates is None:
+                candidates = set(file_cache.keys())
+
+            def matches(rel_path, field, op, value):
+                actual = self.value(rel_path, field)
+                items = actual if isinstance(actual, list) else [actual]
+                if op == "!=":
+                    return all(item is None or metadata_key(item) != metadata_key(value) for item in items)
+                wanted = metadata_sort_key(value)
+                for item in items:
+                    if item is None:
+                        continue
+                    have = metadata_sort_key(item)
+                    if have[0] != wanted[0]:
+                        continue
+                    if (op == ">" and have > wanted) or (op == "<" and have < wanted) or \
+                            (op == ">=" and have >= wanted) or (op == "<=" and have <= wanted):
+                        return True
+                return False
+
+            results = [p for p in candidates if all(matches(p, *f) for f in remaining)]
+            results.sort(key=lambda p: p.lower())
+            if sort:
+                present = [p for p in results if self.value(p, sort) is not None]
+                missing = [p for p in results if self.value(p, sort) is None]
+                present.sort(key=lambda p: metadata_sort_key(self.value(p, sort)), reverse=descending)
+                results = present + missing
+            return results
+
+
+def parse_query_filter(text):
+    """
+    Parse a /api/query filter such as 'status=draft', 'priority>=2' or 'due'
+    (field exists) into (field, op, value). Raises ValueError if malformed.
+    """
+    match = QUERY_FILTER_PATTERN.match(text)
+    if not match or (match.group(2) and match.group(3) is None):
+        raise ValueError(f"Invalid filter '{text}'")
+    field, op, value = match.groups()
+    return field.lower(), op, frontmatter_value(value) if op else None
+
+# -------------------------------------------------------------------
+# Heading outline
+# -------------------------------------------------------------------
+HEADING_PATTERN = re.compile(r'^(#{1,6})[ \t]+(.+?)(?:[ \t]+#+)?[ \t]*$', re.MULTILINE)
+INLINE_MARKUP_PATTERN = re.compile(
+    r'!?\[\[(?:[^\]|]*\|)?(?P<wiki>[^\]]*)\]\]|(?P<image>!)?\[(?P<label>[^\]]*)\]\([^)]*\)'
+    r'|<[^>\n]*>|[*`~]+|(?<!\w)_+|_+(?!\w)'
+)
+
+
+def heading_text(text):
+    """
+    Return the plain text of a heading: wiki links and links reduced to their
+    label, images, raw HTML tags and emphasis markers dropped, entities decoded.
+    Both the outline and the rendered heading ids are slugged from this text.
+    """
+    def replace(m):
+        if m.group("wiki") is not None:
+            return m.group("wiki")
+        if m.group("label") is not None and not m.group("image"):
+            return m.group("label")
+        return ""
+    return " ".join(html.unescape(INLINE_MARKUP_PATTERN.sub(replace, text)).split())
+
+
+def extract_headings(content):
+    """
+    Return the ATX headings of a note as (level, text, slug, offset) tuples.
+    'offset' is where the heading line starts in 'content'; headings in the
+    frontmatter or in fenced code are skipped. Slugs follow the ids the
+    renderer's toc extension gives the same headings.
+    """
+    skipped = [m.span() for m in FENCED_BLOCK_PATTERN.finditer(content)]
+    frontmatter = FRONTMATTER_PATTERN.match(content)
+    if frontmatter:
+        skipped.append(frontmatter.span())
+    headings = []
+    ids = set()
+    for match in HEADING_PATTERN.finditer(content):
+        if any(start <= match.start() < end for start, end in skipped):
+            continue
+        text = heading_text(match.group(2))
+        slug = unique(slugify(text, "-"), ids)
+        headings.append((len(match.group(1)), text, slug, match.start()))
+    return headings
+
+
+class OutlineIndex:
+    """
+    Heading outline of every note, computed once per content change.
+    Offsets are kept sorted per note so the heading enclosing any position
+    is found by bisection.
+    """
+
+    def __init__(self):
+        self.headings = {}  # path -> list of (level, text, slug, offset)
+        self.offsets = {}   # path -> list of heading offsets
+        self.lock = threading.Lock()
+
+    def add(self, rel_path, content):
+        """
+        Index (or re-index) the headings of a single note.
+        """
+        headings = extract_headings(content)
+        with self.lock:
+            self.headings[rel_path] = headings
+            self.offsets[rel_path] = [heading[3] for heading in headings]
+
+    def remove(self, rel_path):
+        """
+        Drop a note from the index.
+        """
+        with self.lock:
+            self.headings.pop(rel_path, None)
+            self.offsets.pop(rel_path, None)
+
+    def outline(self, rel_path):
+        """
+        Return the headings of a note, or None if it is not indexed.
+        """
+        return self.headings.get(rel_path)
+
+    def heading_at(self, rel_path, offset):
+        """
+        Return the heading whose section contains 'offset', or None.
+        """
+        with self.lock:
+            offsets = self.offsets.get(rel_path)
+            if not offsets:
+                return None
+            i = bisect.bisect_right(offsets, offset)
+            return self.headings[rel_path][i - 1] if i else None
+
+# -------------------------------------------------------------------
+# Write-behind queue for autosaves
+# -------------------------------------------------------------------
+class WriteBehindQueue:
+    """
+    Coalescing write-behind queue for editor autosaves.
+    The first autosave of a note schedules its write 'delay' seconds later;
+    autosaves arriving before then only replace the pending content, so a
+    burst of saves costs a single disk write. Writes go through
+    save_file_content on a background thread, and anything still pending is
+    flushed at exit. All writes for the app go through write() or the queue
+    under one I/O lock, so a later explicit save can never be overtaken by
+    an older queued one.
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.pending = {}  # full_path -> [content, due_time]
+        self.cond = threading.Condition()
+        self.io_lock = threading.Lock()
+        self.thread = None
+
+    def enqueue(self, full_path, content):
+        with self.cond:
+            if full_path in self.pending:
+                self.pending[full_path][0] = content
+            else:
+                self.pending[full_path] = [content, time.time() + self.delay]
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="observe-write-behind", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def write(self, full_path, content):
+        """
+        Write content synchronously, superseding anything queued for the file.
+        """
+        with self.io_lock:
+            with self.cond:
+                self.pending.pop(full_path, None)
+            return save_file_content(full_path, content)
+
+    def get(self, full_path):
+        """
+        Return content still waiting to be written for a file, or None.
+        """
+        with self.cond:
+            entry = self.pending.get(full_path)
+            return entry[0] if entry else None
+
+    def discard(self, full_path):
+        """
+        Drop pending writes for a file, or for everything under a directory.
+        """
+        with self.cond:
+            for path in self._matching(full_path):
+                del self.pending[path]
+
+    def flush(self, full_path=None):
+        """
+        Write out pending content now: everything, or only a file / directory.
+        """
+        with self.io_lock:
+            with self.cond:
+                paths = list(self.pending) if full_path is None else self._matching(full_path)
+                items = [(path, self.pending.pop(path)[0]) for path in paths]
+            self._write_items(items)
+
+    def _matching(self, full_path):
+        prefix = full_path.rstrip(os.sep) + os.sep
+        return [path for path in self.pending if path == full_path or path.startswith(prefix)]
+
+    def _write_items(self, items):
+        for path, content in items:
+            if not save_file_content(path, content):
+                logger.error(f"Write-behind failed for {path}, will retry")
+                with self.cond:
+                    self.pending.setdefault(path, [content, time.time() + self.delay])
+
+    def _run(self):
+        while True:
+            with self.cond:
+                now = time.time()
+                if not any(due <= now for _, due in self.pending.values()):
+                    next_due = min((due for _, due in self.pending.values()), default=None)
+                    self.cond.wait(None if next_due is None else next_due - now)
+                    continue
+            with self.io_lock:
+                with self.cond:
+                    now = time.time()
+                    due_paths = [path for path, (_, due) in self.pending.items() if due <= now]
+                    items = [(path, self.pending.pop(path)[0]) for path in due_paths]
+                self._write_items(items)
+
+
+write_queue = WriteBehindQueue(AUTO_SAVE_INTERVAL)
+atexit.register(write_queue.flush)
+
+# -------------------------------------------------------------------
+# Precompute the file tree and content cache on startup
+# -------------------------------------------------------------------
+@app.before_first_request
+def init_data():
+    start = time.time()
+    refresh_file_cache()
+    logger.info(f"Loaded {len(file_cache)} notes in {time.time() - start:.2f}s")
+
+# -------------------------------------------------------------------
+# Markdown rendering
+# -------------------------------------------------------------------
+class RenderCache:
+    """
+    Small LRU cache of rendering results, bounded by the render_cache_mb
+    setting. Each entry is stored with its size in characters.
+    """
+
+    def __init__(self, limit):
+        self.entries = OrderedDict()  # key -> (value, size)
+        self.size = 0
+        self.limit = limit
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            if size > self.limit:
+                return
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.limit:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+
+render_cache = RenderCache(RENDER_CACHE_MB * 1024 * 1024)
+
+TABLE_SEPARATOR_PATTERN = re.compile(r'^\|[-:\|\s]+\|\s*$')
+
+
+def closes_fence(line, marker):
+    """
+    Return whether 'line' closes a fenced block opened with 'marker' (a run
+    of three or more backticks or tildes): the same character, repeated at
+    least as often, and nothing else on the line.
+    """
+    stripped = line.strip()
+    return len(stripped) >= len(marker) and stripped == marker[0] * len(stripped) \
+        and len(line) - len(line.lstrip(" ")) < 4
+
+def split_markdown_chunks(content, chunk_size):
+    """
+    Split a note into chunks of roughly 'chunk_size' characters that can be
+    rendered independently. Chunks end at top-level block boundaries (a blank
+    line followed by an unindented line, outside fenced code, tables and $$ formulas).
+    Long tables are cut between rows, repeating the header rows at the top of
+    the next chunk. Other blocks are cut between lines once they reach twice
+    'chunk_size' without a boundary; an open code fence is closed and reopened.
+    Every chunk but the last ends with a newline.
+    """
+    chunks = []
+    current = []
+    size = 0
+    fence = None         # opening line of the fenced block we are in
+    marker = None        # its ``` or ~~~ run, which the closing fence must repeat
+    table_header = None  # header and separator rows of the table we are in
+    in_math = False      # inside a $$ formula spanning lines
+    previous = ""
+    for line in content.split("\n"):
+        stripped = line.strip()
+        if size >= chunk_size:
+            boundary = fence is None and table_header is None and not in_math \
+                and not previous.strip() and stripped and not line[0].isspace()
+            if boundary or table_header is not None or size >= 2 * chunk_size:
+                if fence is not None:
+                    current.append(marker)
+                # End the chunk with its line break: a table's last row only
+                # matches pipe_table_pattern when followed by a newline
+                chunks.append("\n".join(current) + "\n")
+                current = [fence] if fence is not None else list(table_header or [])
+                size = 0
+        if fence is None and table_header is not None and not stripped.startswith("|"):
+            table_header = None
+        if fence is None and FENCE_PATTERN.match(line):
+            fence, marker = line, FENCE_PATTERN.match(line).group(1)
+        elif fence is not None and closes_fence(line, marker):
+            fence = marker = None
+        elif fence is None and line.count("$$") % 2:
+            in_math = not in_math
+        elif fence is None and table_header is None and TABLE_SEPARATOR_PATTERN.match(stripped) \
+                and previous.strip().startswith("|"):
+            table_header = [previous, line]
+        current.append(line)
+        size += len(line) + 1
+        previous = line
+    chunks.append("\n".join(current))
+    return chunks
+
+def note_chunks(rel_path, version, content):
+    """
+    Return the chunks of a large note (see split_markdown_chunks), split once
+    per content version and kept in render_cache.
+    """
+    key = ("chunks", rel_path, version)
+    chunks = render_cache.get(key)
+    if chunks is None:
+        chunks = split_markdown_chunks(content, RENDER_CHUNK_SIZE)
+        render_cache.put(key, chunks, len(content))
+    return chunks
+
+def chunk_heading_ids(rel_path, version, chunks, index):
+    """
+    Return the heading ids used by the chunks before 'index', so a chunk
+    continues the note's numbering (part, part_1, ...) instead of
+    restarting it. The heading slugs of every chunk are computed once per
+    content version.
+    """
+    key = ("chunk_headings", rel_path, version)
+    slugs = render_cache.get(key)
+    if slugs is None:
+        slugs = [[slugify(text, "-") for _, text, _, _ in extract_headings(chunk)] for chunk in chunks]
+        render_cache.put(key, slugs, sum(len(slug) for chunk in slugs for slug in chunk))
+    ids = set()
+    for chunk in slugs[:index]:
+        for slug in chunk:
+            unique(slug, ids)
+    return ids
+
+def render_chunk(rel_path, version, chunks, index):
+    """
+    Render one chunk of a large note, caching the HTML per content version.
+    """
+    key = ("chunk", rel_path, version, index, render_generation)
+    html_content = render_cache.get(key)
+    if html_content is None:
+        ids = chunk_heading_ids(rel_path, version, chunks, index)
+        html_content = render_markdown(rel_path, chunks[index], ids)
+        render_cache.put(key, html_content, len(html_content))
+    return html_content
+
+# Typesets a JSON list of [tex, display] pairs read from stdin with the KaTeX
+# package at argv[1], writing a JSON list of HTML strings (null on error)
+KATEX_BATCH_SCRIPT = """
+const katex = require(process.argv[1]);
+let input = "";
+process.stdin.on("data", (data) => { input += data; });
+process.stdin.on("end", () => {
+    const output = JSON.parse(input).map(([tex, display]) => {
+        try {
+            return katex.renderToString(tex, {displayMode: display, throwOnError: true});
+        } catch (e) {
+            return null;
+        }
+    });
+    process.stdout.write(JSON.stringify(output));
+});
+"""
+
+def find_math_renderer():
+    """
+    Pick the server-side math renderer once at startup: the KaTeX CLI if it
+    is installed, else latex2mathml if importable, else None (formulas are
+    left for the browser).
+    Returns (renderer, batch_renderer). batch_renderer takes a list of
+    (tex, display) pairs and returns their HTML (None where typesetting
+    failed) in one call: a single node process running the KaTeX package
+    behind the CLI, or the renderer applied to each formula in a small
+    thread pool when that package cannot be located.
+    """
+    if not SERVER_MATH:
+        return None, None
+    katex = shutil.which(KATEX_PATH)
+    if katex:
+        logger.info(f"Server-side math: KaTeX CLI at {katex}")
+        renderer = lambda tex, display: typeset_katex(katex, tex, display)
+        # npm installs the CLI as node_modules/.bin/katex -> ../katex/cli.js
+        package = os.path.dirname(os.path.realpath(katex))
+        node = shutil.which("node")
+        if node and os.path.isfile(os.path.join(package, "package.json")):
+            return renderer, lambda formulas: typeset_katex_batch(node, package, formulas)
+        return renderer, lambda formulas: list(math_pool.map(lambda formula: renderer(*formula), formulas))
+    if latex_to_mathml is not None:
+        logger.info("Server-side math: latex2mathml")
+        renderer = lambda tex, display: latex_to_mathml(tex, display="block" if display else "inline")
+        return renderer, lambda formulas: [renderer(*formula) for formula in formulas]
+    logger.warning("server_math is enabled but neither the KaTeX CLI nor latex2mathml is available")
+    return None, None
+
+def typeset_katex(katex, tex, display):
+    """
+    Typeset one formula with the KaTeX CLI. Returns the HTML, or None if
+    KaTeX rejects the formula.
+    """
+    args = [katex, "--display-mode"] if display else [katex]
+    result = subprocess.run(args, input=tex, capture_output=True, text=True, timeout=10)
+    if result.returncode != 0:
+        logger.debug(f"KaTeX could not render {tex!r}: {result.stderr.strip()}")
+        return None
+    return result.stdout.strip()
+
+def typeset_katex_batch(node, package, formulas):
+    """
+    Typeset many formulas with one node process running the KaTeX package
+    in 'package'. Returns the HTML per formula, None where KaTeX rejects it.
+    """
+    result = subprocess.run(
+        [node, "-e", KATEX_BATCH_SCRIPT, package],
+        input=json.dumps(formulas), capture_output=True, text=True, timeout=30
+    )
+    if result.returncode != 0:
+        logger.debug(f"KaTeX batch failed: {result.stderr.strip()}")
+        return [None] * len(formulas)
+    return json.loads(result.stdout)
+
+def typeset_formulas(formulas):
+    """
+    Typeset every formula of a render that is not in render_cache yet in a
+    single batch, so render_math then finds them all cached and a note with
+    hundreds of formulas costs one KaTeX start rather than hundreds.
+    """
+    if math_batch_renderer is None:
+        return
+    pending = list(dict.fromkeys(
+        (tex, display) for tex, display in formulas if render_cache.get(("math", display, tex)) is None
+    ))
+    if not pending:
+        return
+    try:
+        typeset = math_batch_renderer(pending)
+    except Exception as e:
+        logger.debug(f"Server-side math failed for {len(pending)} formulas: {str(e)}")
+        typeset = [None] * len(pending)
+    for (tex, display), output in zip(pending, typeset):
+        store_math(tex, display, output)
+
+def store_math(tex, display, typeset):
+    """
+    Cache and return the HTML for one formula given its typeset output, or
+    the browser fallback if 'typeset' is None.
+    """
+    tag, css = ("div", "math-display") if display else ("span", "math-inline")
+    if typeset:
+        rendered = f'<{tag} class="{css} math-rendered">{typeset}</{tag}>'
+    else:
+        rendered = f'<{tag} class="{css}">{html.escape(tex, quote=False)}</{tag}>'
+    render_cache.put(("math", display, tex), rendered, len(rendered))
+    return rendered
+
+def render_math(tex, display):
+    """
+    Return the HTML for one formula, given its TeX source as written in the
+    note. With server_math, the typeset result is cached per
+    formula in render_cache, so a formula is typeset once however many notes
+    or blocks repeat it. Otherwise, or if typesetting fails, the TeX source is
+    wrapped (escaped) in a math-display / math-inline container for the browser.
+    """
+    if math_renderer is None:
+        tag, css = ("div", "math-display") if display else ("span", "math-inline")
+        return f'<{tag} class="{css}">{html.escape(tex, quote=False)}</{tag}>'
+    rendered = render_cache.get(("math", display, tex))
+    if rendered is None:
+        try:
+            typeset = math_renderer(tex, display)
+        except Exception as e:
+            logger.debug(f"Server-side math failed for {tex!r}: {str(e)}")
+            typeset = None
+        rendered = store_math(tex, display, typeset)
+    return rendered
+
+math_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="observe-math")
+math_renderer, math_batch_renderer = find_math_renderer()
+
+code_lexers = {}  # language -> Pygments lexer, or None if Pygments does not know it
+code_formatter = HtmlFormatter(nowrap=True) if pygments_highlight is not None else None
+
+def code_lexer(lang):
+    """
+    Return the Pygments lexer for a fenced-code language, resolving each
+    language name only once.
+    """
+    lang = lang.lower()
+    if lang not in code_lexers:
+        try:
+            code_lexers[lang] = get_lexer_by_name(lang, stripnl=False, ensurenl=False)
+        except ClassNotFound:
+            code_lexers[lang] = None
+    return code_lexers[lang]
+
+def highlight_code(lang, code):
+    """
+    Return the HTML for one fenced code block. Blocks in a language Pygments
+    knows are highlighted, with the result cached in render_cache by
+    (language, code hash); others (or all, without Pygments) are escaped.
+    """
+    lang_attr = f' class="language-{lang}"' if lang else ''
+    lexer = code_lexer(lang) if lang and pygments_highlight is not None else None
+    if lexer is None:
+        return f'<div class="codehilite"><pre><code{lang_attr}>{html.escape(code)}</code></pre></div>'
+    key = ("code", lang.lower(), hashlib.sha1(code.encode("utf-8")).hexdigest())
+    code_html = render_cache.get(key)
+    if code_html is None:
+        highlighted = pygments_highlight(code, lexer, code_formatter)
+        if not code.endswith("\n"):
+            highlighted = highlighted.rstrip("\n")
+        code_html = f'<div class="codehilite"><pre><code{lang_attr}>{highlighted}</code></pre></div>'
+        render_cache.put(key, code_html, len(code_html))
+    return code_html
+
+def find_mermaid_renderer():
+    """
+    Resolve the mermaid-cli (mmdc) binary once at startup, or None when
+    server_mermaid is off or mmdc is not installed (diagrams are then laid
+    out in the browser).
+    """
+    if not SERVER_MERMAID:
+        return None
+    mmdc = shutil.which(MMDC_PATH)
+    if mmdc:
+        logger.info(f"Server-side mermaid: mmdc at {mmdc}")
+    else:
+        logger.warning("server_mermaid is enabled but mmdc is not installed")
+    return mmdc
+
+def render_mermaid(source):
+    """
+    Return the HTML for one mermaid block. With server_mermaid, the diagram
+    is rendered to SVG by mmdc, with an SVG id derived from the source hash,
+    and cached in render_cache by that hash; otherwise, or if mmdc fails, the
+    source is left in a 'mermaid' div for mermaid.js to lay out in the browser.
+    """
+    fallback = f'<div class="mermaid">{source}</div>'
+    if mermaid_cli is None:
+        return fallback
+    digest = hashlib.sha1(source.encode("utf-8")).hexdigest()
+    key = ("mermaid", digest)
+    rendered = render_cache.get(key)
+    if rendered is None:
+        svg = None
+        with tempfile.TemporaryDirectory(prefix="observe-mermaid-") as tmp_dir:
+            input_path = os.path.join(tmp_dir, "diagram.mmd")
+            output_path = os.path.join(tmp_dir, "diagram.svg")
+            with open(input_path, "w", encoding="utf-8") as f:
+                f.write(source)
+            try:
+                result = subprocess.run(
+                    # mmdc names every SVG 'my-svg' by default; its styles are scoped
+                    # by that id, so diagrams on one page need distinct ids
+                    [mermaid_cli, "-i", input_path, "-o", output_path, "-b", "transparent",
+                     "-I", f"mermaid-{digest[:16]}"],
+                    capture_output=True, text=True, timeout=60
+                )
+                if result.returncode == 0 and os.path.exists(output_path):
+                    with open(output_path, "r", encoding="utf-8") as f:
+                        svg = f.read()
+                else:
+                    logger.debug(f"mmdc could not render diagram: {result.stderr.strip()}")
+            except (OSError, subprocess.TimeoutExpired) as e:
+                logger.error(f"mmdc failed: {str(e)}")
+        rendered = f'<div class="mermaid-svg">{svg}</div>' if svg else fallback
+        render_cache.put(key, rendered, len(rendered))
+    return rendered
+
+mermaid_cli = find_mermaid_renderer()
+
+# Constructs whose rendering depends on other blocks: reference definitions,
+# footnotes, abbreviations, raw HTML, a [TOC] marker, and blockquotes or
+# definitions that continue after a blank line (they merge with the block above)
+BLOCK_SPANNING_PATTERN = re.compile(
+    r'^ {0,3}(?:\*?\[[^\]]+\]:|<|\[TOC\][ \t]*$)'
+    r'|^ {0,3}>[^\n]*\n(?:[ \t]*\n)+ {0,3}>'
+    r'|^[ \t]*\n {0,3}:[ \t]',
+    re.MULTILINE,
+)
+LIST_ITEM_PATTERN = re.compile(r'^(?:[-*+]|\d+[.)])\s')
+HEADING_ID_PATTERN = re.compile(r'(<h[1-6] id=")([^"]*)(")')
+
+
+def split_markdown_blocks(content):
+    """
+    Split a note into its top-level blocks: runs of lines that start after a
+    blank line with an unindented line, outside fenced code. List items
+    separated by blank lines stay in one block.
+    A $$ display formula spanning blank lines stays in one block as well.
+    Returns None if the note uses constructs that reach across blocks
+    (reference links, footnotes, abbreviations, raw HTML, [TOC], blockquotes
+    and definitions continued after a blank line); such notes render as a whole.
+    """
+    if BLOCK_SPANNING_PATTERN.search(content):
+        return None
+    blocks = []
+    current = []
+    fence = None  # ``` or ~~~ run of the open fenced block
+    in_math = False  # inside a $$ formula spanning lines
+    in_list = False
+    previous = ""
+    for line in content.split("\n"):
+        stripped = line.strip()
+        if fence is None and not in_math and current and stripped and not previous.strip() \
+                and not line[0].isspace():
+            is_item = bool(LIST_ITEM_PATTERN.match(line))
+            if not (in_list and is_item):
+                blocks.append("\n".join(current))
+                current = []
+                in_list = False
+        if fence is None and FENCE_PATTERN.match(line):
+            fence = FENCE_PATTERN.match(line).group(1)
+        elif fence is not None:
+            if closes_fence(line, fence):
+                fence = None
+        elif line.count("$$") % 2:
+            in_math = not in_math
+        elif not line[:1].isspace() and LIST_ITEM_PATTERN.match(line):
+            in_list = True
+        current.append(line)
+        previous = line
+    blocks.append("\n".join(current))
+    return blocks
+
+def render_markdown(rel_path, content, ids=None):
+    """
+    Render a note block by block (see split_markdown_blocks), reusing the
+    cached HTML of every block whose source is unchanged, so re-rendering an
+    edited note only converts the blocks that changed. Blocks are cached by
+    source hash, directory of the note (relative links depend on it) and
+    render_generation. Heading ids are made unique across the whole note;
+    'ids' holds those already used earlier in it (by previous chunks).
+    """
+    ids = set(ids or ())
+    blocks = split_markdown_blocks(content)
+    if blocks is None or len(blocks) < 2:
+        html_content = convert_markdown(rel_path, content)
+    else:
+        directory = os.path.dirname(rel_path)
+        parts = []
+        for block in blocks:
+            key = ("block", directory, render_generation, hashlib.sha1(block.encode("utf-8")).hexdigest())
+            block_html = render_cache.get(key)
+            if block_html is None:
+                block_html = convert_markdown(rel_path, block)
+                render_cache.put(key, block_html, len(block_html))
+            parts.append(block_html)
+        html_content = "\n".join(parts)
+
+    return HEADING_ID_PATTERN.sub(
+        lambda m: m.group(1) + unique(m.group(2), ids) + m.group(3),
+        html_content
+    )
+
+# One alternation over the converted HTML replaces the chain of re.sub passes
+# that used to copy the whole document once per feature. Branches are tried
+# in order at each position: placeholders and unconverted fences first, then
+# code/svg and plain HTML tags (copied verbatim, so attributes such as href
+# are never rewritten), then the inline markup.
+POSTPROCESS_PATTERN = re.compile(r'''
+    (?P<placeholder>(?:CODE_BLOCK|MERMAID)_PLACEHOLDER_\d+|MATH_PLACEHOLDER_\d+_)
+  | <p>```(?P<fence_lang>\w*)\s*(?P<fence_code>.*?)\s*```</p>
+  | (?P<verbatim><pre\b.*?</pre>|<code\b.*?</code>|<svg\b.*?</svg>)
+  | (?P<empty_cell><td[^>]*></td>)
+  | (?P<table_open><table>)
+  | (?P<table_close></table>)
+  | (?P<cell><t[dh]>)
+  | <blockquote>(?P<callout_space>\s*)<p>\[!(?P<callout>\w+)\][ \t]*
+  | <li>\[(?P<task_item>[xX ])\][ \t]*
+  | (?P<html_tag><[^>]*>|&\#?\w+;)
+  | \[\[(?P<wiki>[^\n]*?)\]\]
+  | -\ \[(?P<task>x|\ )\]\ (?P<task_text>[^\n]*)
+  | \#(?P<tag>\w+)
+  | @(?P<mention>\w+)
+''', re.VERBOSE | re.DOTALL)
+
+TABLE_CELL_STYLE = "vertical-align: middle; padding: 8px;"
+
+# $$display$$ and $inline$ formulas in the markdown source; like pandoc, an
+# inline formula may not start or end with a space nor be followed by a digit,
+# so prices such as "$5 and $10" stay text. Inline code, link
+# targets, HTML comments and tags are matched too, so a '$' inside them is
+# left alone; fenced and indented code is skipped before matching.
+MATH_PATTERN = re.compile(
+    r'(?P<skip>(?P<ticks>`+).+?(?<!`)(?P=ticks)(?!`)|\]\([^)\n]*\)|<!--.*?-->|<[^>\n]*>)'
+    r'|\$\$(?P<display>.+?)\$\$|\$(?P<inline>[^\s$](?:[^\n$]*?[^\s$])?)\$(?!\d)',
+    re.DOTALL
+)
+INDENTED_CODE_PATTERN = re.compile(r'(?:\A|(?<=\n\n))(?:(?: {4}|\t)[^\n]*(?:\n|\Z))+')
+# Terminated by '_' so digits that follow the formula are not read as part of it
+MATH_PLACEHOLDER_PATTERN = re.compile(r'MATH_PLACEHOLDER_\d+_')
+
+def extract_math(content, math_blocks):
+    """
+    Replace the formulas outside code in 'content' with placeholders,
+    recording (tex, display, source) for each in 'math_blocks'.
+    """
+    def save_math_block(match):
+        if match.group("skip"):
+            return match.group(0)
+        display = match.group("display") is not None
+        placeholder = f'MATH_PLACEHOLDER_{len(math_blocks)}_'
+        tex = match.group("display") if display else match.group("inline")
+        math_blocks[placeholder] = (tex, display, match.group(0))
+        return placeholder
+
+    code = sorted(
+        [m.span() for m in FENCED_BLOCK_PATTERN.finditer(content)]
+        + [m.span() for m in INDENTED_CODE_PATTERN.finditer(content)]
+    )
+    pieces = []
+    last = 0
+    for start, end in code + [(len(content), len(content))]:
+        if start < last:
+            start = last  # Overlapping spans (an indented fence)
+        pieces.append(MATH_PATTERN.sub(save_math_block, content[last:start]))
+        pieces.append(content[start:end])
+        last = max(last, end)
+    return ''.join(pieces)
+
+def restore_math_source(text, math_blocks):
+    """
+    Put back the original $...$ text of any math placeholder in 'text', for
+    places formulas are not rendered (code, attributes, heading ids).
+    """
+    if not math_blocks or "MATH_PLACEHOLDER_" not in text:
+        return text
+    return MATH_PLACEHOLDER_PATTERN.sub(
+        lambda m: math_blocks[m.group(0)][2] if m.group(0) in math_blocks else m.group(0),
+        text
+    )
+
+def wiki_link_html(text):
+    """
+    Render the inside of a [[target#heading|label]] wiki-link as an anchor.
+    A heading becomes a fragment matching the rendered heading ids.
+    """
+    target, _, label = html.unescape(text).partition('|')
+    name, _, heading = target.partition('#')
+    label = html.escape(label.strip() or name.strip() or heading.strip())
+    fragment = f'#{slugify(heading_text(heading), "-")}' if heading.strip() else ''
+    if not name.strip() and fragment:
+        return f'<a href="{fragment}" class="wiki-link">{label}</a>'
+    resolved = name_index.resolve(wiki_link_key(name))
+    if resolved is None:
+        return f'<a href="#" class="wiki-link broken-link">{label}</a>'
+    href = quote(resolved.replace(os.sep, '/'))
+    return f'<a href="/view/{href}{fragment}" class="wiki-link">{label}</a>'
+
+def postprocess_html(html_content, code_blocks, mermaid_blocks, math_blocks):
+    """
+    Restore the code/mermaid/math placeholders and render wiki-links, tags,
+    mentions, callouts, task lists and table styling in a single
+    scan of the converted HTML. Replacements are never rescanned, and tags,
+    entities and code are skipped, so '#' in attributes, '&#39;' or code
+    comments no longer turn into tags.
+    """
+    def replace(m):
+        kind = m.lastgroup
+        if kind == "placeholder":
+            placeholder = m.group("placeholder")
+            if placeholder in code_blocks:
+                return highlight_code(*code_blocks[placeholder])
+            if placeholder in mermaid_blocks:
+                return render_mermaid(mermaid_blocks[placeholder])
+            if placeholder in math_blocks:
+                tex, display, _ = math_blocks[placeholder]
+                return render_math(tex, display)
+            return placeholder
+        if kind in ("fence_lang", "fence_code"):
+            lang = m.group("fence_lang")
+            code = html.escape(restore_math_source(m.group("fence_code"), math_blocks))
+            if lang:
+                return f'<div class="codehilite"><pre><code class="language-{lang}">{code}</code></pre></div>'
+            return f'<div class="codehilite"><pre><code>{code}</code></pre></div>'
+        if kind in ("verbatim", "html_tag"):
+            return restore_math_source(m.group(0), escaped_math_blocks)
+        if kind == "empty_cell":
+            return f'<td style="{TABLE_CELL_STYLE}">&nbsp;</td>'
+        if kind == "table_open":
+            return '<div class="table-responsive"><table class="table table-bordered table-striped">'
+        if kind == "table_close":
+            return '</table></div>'
+        if kind == "cell":
+            if m.group("cell") == "<th>":
+                return f'<th style="{TABLE_CELL_STYLE} background-color: #f8f9fa;">'
+            return f'<td style="{TABLE_CELL_STYLE}">'
+        if kind == "callout":
+            return f'<blockquote class="callout callout-{m.group("callout").lower()}">{m.group("callout_space")}<p>'
+        if kind == "task_item":
+            checked = "checked" if m.group("task_item") in "xX" else ""
+            return f'<li class="task-list-item"><input type="checkbox" {checked}> '
+        if kind == "wiki":
+            return wiki_link_html(m.group("wiki"))
+        if kind in ("task", "task_text"):
+            checked = "checked" if m.group("task") == "x" else ""
+            return f'<li class="task-list-item"><input type="checkbox" {checked}> {m.group("task_text")}</li>'
+        if kind == "tag":
+            return f'<span class="tag">#{m.group("tag")}</span>'
+        return f'<span class="mention">@{m.group("mention")}</span>'
+
+    typeset_formulas((tex, display) for tex, display, _ in math_blocks.values())
+    # Formulas left inside code or attributes go back to their (escaped) source
+    escaped_math_blocks = {
+        placeholder: (tex, display, html.escape(source))
+        for placeholder, (tex, display, source) in math_blocks.items()
+    }
+    return POSTPROCESS_PATTERN.sub(replace, html_content)
+
+MARKDOWN_EXTENSIONS = [
+    "fenced_code",      # Handle code blocks FIRST
+    "codehilite",       # Syntax highlighting for code blocks
+    "tables",           # Then process tables
+    "footnotes",        # The rest of "extra"; abbr is only loaded per note, see convert_markdown
+    "sane_lists",       # Fixes numbered list rendering
+    "toc",              # Heading ids, matching the /api/outline slugs
+    "attr_list",        # Adds support for attributes in lists
+    "def_list",         # Definition lists
+    "md_in_html",       # Markdown inside HTML
+    "nl2br",            # Convert newlines to <br> AFTER table processing
+]
+ABBREVIATION_PATTERN = re.compile(r'^ {0,3}\*\[[^\]]+\]:', re.MULTILINE)
+
+markdown_converters = threading.local()
+
+def heading_slug(value, separator):
+    """
+    Slugify hook for the toc extension: heading ids are computed from the
+    heading text with its formulas put back and reduced by heading_text, as
+    extract_headings sees it (wiki links are still unconverted at this point).
+    """
+    return slugify(heading_text(restore_math_source(value, getattr(markdown_converters, "math_blocks", None))), separator)
+
+MARKDOWN_EXTENSION_CONFIGS = {"toc": {"slugify": heading_slug}}
+
+def markdown_converter():
+    """
+    Return this thread's Markdown instance. Building one (loading every
+    extension) costs more than converting a typical block, so it is created
+    once per thread and reset between conversions. It has no abbr extension:
+    reset() does not forget abbreviations, which would leak into other notes.
+    """
+    converter = getattr(markdown_converters, "converter", None)
+    if converter is None:
+        converter = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS, extension_configs=MARKDOWN_EXTENSION_CONFIGS)
+        markdown_converters.converter = converter
+    return converter
+
+def convert_markdown(rel_path, content):
+    """
+    Render the markdown of the note 'rel_path' (newlines normalized,
+    frontmatter removed) to HTML with:
+    - Properly formatted tables with Bootstrap styling
+    - Single newlines converted to <br>
+    - Correctly rendered numbered lists
+    - Wiki-links, tags, mentions, callouts, task lists and math
+    """
+    # Special handling for mermaid diagrams - FIRST, before any other code block processing
+    mermaid_blocks = {}
+    mermaid_pattern = r'```mermaid\s*\n(.*?)\n\s*```'
+    
+    def save_mermaid_block(match):
+        mermaid_content = match.group(1)
+        placeholder = f'MERMAID_PLACEHOLDER_{len(mermaid_blocks)}'
+        mermaid_blocks[placeholder] = mermaid_content
+        return placeholder
+    
+    content = re.sub(mermaid_pattern, save_mermaid_block, content, flags=re.DOTALL)
+    
+    # Pre-process other code blocks after mermaid blocks are extracted
+    code_blocks = {}
+    code_block_pattern = r'```(\w*)\s*\n(.*?)\n\s*```'
+    
+    def save_code_block(match):
+        lang = match.group(1) or ''
+        code = match.group(2)
+        placeholder = f'CODE_BLOCK_PLACEHOLDER_{len(code_blocks)}'
+        code_blocks[placeholder] = (lang, code)
+        return placeholder
+    
+    content = re.sub(code_block_pattern, save_code_block, content, flags=re.DOTALL)
+    
+    # Pull out math too, so formulas reach render_math as TeX rather than HTML
+    math_blocks = {}
+    content = extract_math(content, math_blocks)
+    
+    # Pre-process pipe tables - convert Markdown pipe tables to HTML tables
+    pipe_table_pattern = r'^\|(.+)\|\s*$\n^\|[-:\|\s]+\|\s*$\n((?:^\|.+\|\s*$\n)+)'
+    
+    def convert_pipe_table_to_html(match):
+        header_row = match.group(1).strip()
+        header_cells = [cell.strip() for cell in header_row.split('|') if cell.strip()]
+    
+        content_rows = match.group(2).strip().split('\n')
+        rows_html = []
+    
+        # Create header HTML
+        header_html = '<tr>\n' + ''.join([f'<th>{cell}</th>\n' for cell in header_cells]) + '</tr>'
+    
+        # Process content rows
+        for row in content_rows:
+            cells = [cell.strip() for cell in row.split('|')[1:-1]]  # Skip first and last empty cells
+            row_html = '<tr>\n' + ''.join([f'<td>{cell}</td>\n' for cell in cells]) + '</tr>'
+            rows_html.append(row_html)
+    
+        # Combine into final table HTML
+        table_html = f'<table>\n<thead>\n{header_html}\n</thead>\n<tbody>\n{"".join(rows_html)}\n</tbody>\n</table>'
+        return table_html
+    
+    # Process relative links BEFORE markdown conversion
+    def process_relative_links_md(match):
+        link_text = match.group(1)
+        # Resolve relative links against the in-memory tree; flag broken ones
+        link_url, exists = resolve_view_link(rel_path, match.group(2))
+        if not exists:
+            return f'[{link_text}]({link_url}){{: .broken-link}}'
+        return f'[{link_text}]({link_url})'
+    
+    # Process markdown links before conversion
+    content = re.sub(
+        r'\[([^\]]+)\]\(([^)]+)\)',
+        process_relative_links_md,
+        content
+    )
+    
+    # Apply the pipe table conversion before markdown processing
+    content = re.sub(pipe_table_pattern, convert_pipe_table_to_html, content, flags=re.MULTILINE)
+    
+    # Convert Markdown to HTML with correct list rendering
+    if ABBREVIATION_PATTERN.search(content):
+        # Abbreviation definitions get a converter of their own (see markdown_converter)
+        converter = markdown.Markdown(
+            extensions=MARKDOWN_EXTENSIONS + ["abbr"],
+            extension_configs=MARKDOWN_EXTENSION_CONFIGS,
         )
+    else:
+        converter = markdown_converter().reset()
+    markdown_converters.math_blocks = math_blocks  # read by heading_slug
+    html_content = converter.convert(content)
+    
+    # Restore code/mermaid blocks and apply the Obsidian-style markup in one pass
+    return postprocess_html(html_content, code_blocks, mermaid_blocks, math_blocks)
+
+@app.route("/")
+def index():
+    """
+    Serve a Bootstrap-based page that calls our API endpoints
+    and displays a professional-looking interface.
+    - File list hides '.md'
+    - Search results are collapsible
+    - Clicking a search result highlights the match
+    - Title is added above each rendered document, with an extra <br> after
+    - The Clear button has no text, uses the same styling as the search button,
+      and is placed next to the search button.
+    """
+    return render_template_string(html_template, page_title=PAGE_TITLE, editor_theme=EDITOR_THEME, auto_save_interval=AUTO_SAVE_INTERVAL)
+
+@app.route("/view/<path:file_path>")
+def view_file(file_path):
+    """
+    Serve the main page but with a specific file loaded.
+    The JavaScript will detect the path and load the file.
+    """
+    try:
+        logger.debug(f"View file request for path: {file_path}")
+        
+        # Verify if the file exists - this helps us fail early with a better error message
+        full_path = os.path.join(CONTENT_ROOT, file_path)
+        if not is_safe_path(full_path):
+            logger.error(f"Unsafe path attempted: {full_path}")
+            return "Invalid file path", 400
+            
+        if not os.path.exists(full_path):
+            logger.error(f"File not found: {full_path}")
+            return "File not found", 404
+            
+        # File exists, render the template
+        return render_template_string(html_template, page_title=PAGE_TITLE, editor_theme=EDITOR_THEME, auto_save_interval=AUTO_SAVE_INTERVAL)
+    except Exception as e:
+        logger.error(f"Error in view_file: {str(e)}")
+        return f"Server error: {str(e)}", 500
+
+@app.route("/api/tree")
+def api_tree():
+    """
+    Return the directory tree as JSON.
+    """
+    return jsonify(file_tree)
 
-        # Process mentions (now safe from href content)
-        html_content = re.sub(
-            r'@(\w+)',
-            lambda m: f'<span class="mention">@{m.group(1)}</span>',
-            html_content
-        )
+@app.route("/api/file")
+def api_file():
+    """
+    Return the rendered HTML of a specific .md file with:
+    - Properly formatted tables with Bootstrap styling
+    - Single newlines converted to <br>
+    - Improved spacing and grid layout
+    - Correctly rendered numbered lists
+    """
+    try:
+        rel_path = request.args.get("path", "")
+        rel_path = rel_path.replace('/', os.sep)
+        logger.debug(f"API file request for path: {rel_path}")
         
-        # Restore href attributes
-        for placeholder, href_content in href_placeholders.items():
-            html_content = html_content.replace(f'href="{placeholder}"', f'href="{href_content}"')
+        if not rel_path:
+            return jsonify({"error": "No file path specified."})
 
-        # Process callouts
-        html_content = re.sub(
-            r'>\s*\[!(\w+)\](.*?)(?=\n\n|\Z)',
-            lambda m: f'<div class="callout callout-{m.group(1).lower()}">{m.group(2).strip()}</div>',
-            html_content,
-            flags=re.DOTALL
-        )
+        full_path = os.path.join(CONTENT_ROOT, rel_path)
+        logger.debug(f"Full path: {full_path}")
+        
+        if not is_safe_path(full_path):
+            logger.error(f"Invalid path attempted: {full_path}")
+            return jsonify({"error": "Invalid path."})
 
-        # Process task lists
-        html_content = re.sub(
-            r'- \[(x| )\] (.*)',
-            lambda m: f'<li class="task-list-item"><input type="checkbox" {"checked" if m.group(1) == "x" else ""}> {m.group(2)}</li>',
-            html_content
-        )
+        # Check directly if file exists on disk
+        if not os.path.exists(full_path):
+            logger.error(f"File not found on disk: {full_path}")
+            return jsonify({"error": f"File '{rel_path}' not found on disk."})
 
-        # Process math equations
-        html_content = re.sub(
-            r'\$\$(.*?)\$\$',
-            lambda m: f'<div class="math-display">{m.group(1)}</div>',
-            html_content,
-            flags=re.DOTALL
-        )
-        html_content = re.sub(
-            r'\$(.*?)\$',
-            lambda m: f'<span class="math-inline">{m.group(1)}</span>',
-            html_content
-        )
+        # Add a note created outside the app to the cache, without rescanning the vault
+        if rel_path not in file_cache:
+            logger.info(f"File not found in cache, reading it from disk: {rel_path}")
+            try:
+                with open(full_path, "r", encoding="utf-8") as f:
+                    content = f.read()
+            except Exception as e:
+                logger.error(f"Error reading file from disk: {str(e)}")
+                return jsonify({"error": f"File '{rel_path}' could not be read: {str(e)}"})
+            with note_lock:
+                update_cached_note(rel_path, content)
+                rebuild_file_tree()
+            
+        content = file_cache[rel_path]
 
-        # Apply Bootstrap styles to tables
-        html_content = re.sub(r"<table>", '<div class="table-responsive"><table class="table table-bordered table-striped">', html_content)
-        html_content = re.sub(r"</table>", '</table></div>', html_content)
-        
-        # Ensure table cells are properly styled
-        html_content = re.sub(r"<td>", '<td style="vertical-align: middle; padding: 8px;">', html_content)
-        html_content = re.sub(r"<th>", '<th style="vertical-align: middle; padding: 8px; background-color: #f8f9fa;">', html_content)
+        # Normalize newlines to Unix-style
+        content = content.replace("\r\n", "\n").replace("\r", "\n")
 
-        # Fix for empty table cells - ensure all <td></td> pairs have content
-        html_content = re.sub(r"<td[^>]*></td>", '<td style="vertical-align: middle; padding: 8px;">&nbsp;</td>', html_content)
+        # Frontmatter is metadata (see /api/query), not part of the rendered note
+        content = FRONTMATTER_PATTERN.sub("", content, 1)
+
+        if len(content) > RENDER_CHUNK_SIZE:
+            # Large notes are rendered chunk by chunk; the rest is fetched from
+            # /api/file/chunk as the user scrolls
+            version = content_version(file_cache[rel_path])
+            chunks = note_chunks(rel_path, version, content)
+            return jsonify({
+                "html": render_chunk(rel_path, version, chunks, 0),
+                "version": version,
+                "frontmatter": meta_index.get(rel_path),
+                "chunks": len(chunks)
+            })
+
+        html_content = render_markdown(rel_path, content)
 
-        return jsonify({"html": html_content})
+        return jsonify({
+            "html": html_content,
+            "version": content_version(file_cache[rel_path]),
+            "frontmatter": meta_index.get(rel_path)
+        })
     except Exception as e:
         logger.error(f"Error in api_file: {str(e)}")
         import traceback
         logger.error(traceback.format_exc())
         return jsonify({"error": f"Server error: {str(e)}"})
 
+@app.route("/api/file/chunk")
+def api_file_chunk():
+    """
+    Return one chunk of a large note rendered by /api/file:
+    /api/file/chunk?path=<note>&index=<n>&version=<version from /api/file>
+    Answers 409 with the current version if the note changed in between.
+    """
+    rel_path = request.args.get("path", "").replace('/', os.sep)
+    if not rel_path:
+        return jsonify({"error": "No file path specified."}), 400
+
+    if not is_safe_path(os.path.join(CONTENT_ROOT, rel_path)):
+        return jsonify({"error": "Invalid path."}), 400
+
+    try:
+        index = int(request.args.get("index", 0))
+    except ValueError:
+        return jsonify({"error": "Invalid index."}), 400
+
+    content = file_cache.get(rel_path)
+    if content is None:
+        return jsonify({"error": f"File '{rel_path}' not found."}), 404
+
+    version = content_version(content)
+    if request.args.get("version", version) != version:
+        return jsonify({"error": "The note has changed.", "conflict": True, "version": version}), 409
+
+    content = FRONTMATTER_PATTERN.sub("", content.replace("\r\n", "\n").replace("\r", "\n"), 1)
+    chunks = note_chunks(rel_path, version, content)
+    if not 0 <= index < len(chunks):
+        return jsonify({"error": "Invalid index."}), 400
+
+    return jsonify({
+        "html": render_chunk(rel_path, version, chunks, index),
+        "index": index,
+        "chunks": len(chunks),
+        "version": version
+    })
+
 @app.route("/api/file_with_highlight")
 def api_file_with_highlight():
     """
@@ -3110,6 +5725,12 @@ def api_file_with_highlight():
     content = file_cache[rel_path]
     content = content.replace("\r\n", "\n").replace("\r", "\n")
 
+    # Leave out the frontmatter; offsets inside it fall back to no highlight
+    frontmatter = FRONTMATTER_PATTERN.match(content)
+    if frontmatter:
+        content = content[frontmatter.end():]
+        start -= frontmatter.end()
+
     # Insert a highlight placeholder around the matched substring
     end = start + length
     if start < 0 or end > len(content):
@@ -3174,22 +5795,10 @@ def api_file_with_highlight():
     # Process relative links BEFORE markdown conversion
     def process_relative_links_md(match):
         link_text = match.group(1)
-        link_url = match.group(2)
-        
-        # If it's a relative link (not starting with http://, https://, or #)
-        if not (link_url.startswith('http://') or link_url.startswith('https://') or link_url.startswith('#')):
-            # Get the directory of the current file
-            current_dir = os.path.dirname(rel_path)
-            # Construct the full path relative to the current file
-            full_link_path = os.path.normpath(os.path.join(current_dir, link_url))
-            # Convert back to URL format
-            link_url = full_link_path.replace(os.sep, '/')
-            # Add .md extension if not present and not a directory
-            if not os.path.isdir(os.path.join(CONTENT_ROOT, full_link_path)) and not link_url.endswith('.md'):
-                link_url += '.md'
-            # Convert to a URL that the app can handle
-            link_url = f'/view/{link_url}'
-        
+        # Resolve relative links against the in-memory tree; flag broken ones
+        link_url, exists = resolve_view_link(rel_path, match.group(2))
+        if not exists:
+            return f'[{link_text}]({link_url}){{: .broken-link}}'
         return f'[{link_text}]({link_url})'
 
     # Process markdown links before conversion
@@ -3211,19 +5820,23 @@ def api_file_with_highlight():
             "tables",           # Then process tables
             "extra",            # Adds support for footnotes, abbreviations, etc.
             "sane_lists",       # Fixes numbered list rendering
+            "toc",              # Heading ids, matching the /api/outline slugs
         ],
     )
 
     # Restore code blocks
     for placeholder, (lang, code) in code_blocks.items():
-        lang_attr = f' class="language-{lang}"' if lang else ''
-        escaped_code = html.escape(code)
-        code_html = f'<div class="codehilite"><pre><code{lang_attr}>{escaped_code}</code></pre></div>'
+        if "[[HL]]" in code or "[[/HL]]" in code:
+            # Keep the highlight markers intact rather than lexing them
+            lang_attr = f' class="language-{lang}"' if lang else ''
+            code_html = f'<div class="codehilite"><pre><code{lang_attr}>{html.escape(code)}</code></pre></div>'
+        else:
+            code_html = highlight_code(lang, code)
         html_content = html_content.replace(placeholder, code_html)
 
     # Restore mermaid blocks
     for placeholder, mermaid_content in mermaid_blocks.items():
-        html_content = html_content.replace(placeholder, f'<div class="mermaid">{mermaid_content}</div>')
+        html_content = html_content.replace(placeholder, render_mermaid(mermaid_content))
 
     # Replace highlight placeholders with actual HTML
     html_content = html_content.replace(
@@ -3248,11 +5861,72 @@ def api_file_with_highlight():
     return jsonify({"html": html_content})
 
 
+@app.route("/api/tags")
+def api_tags():
+    """
+    List every tag (inline #tags and frontmatter tags) with note counts:
+    { "tags": [{ "tag", "count", "total" }] }, where 'total' also counts
+    notes with nested tags ('project' includes 'project/alpha').
+    """
+    ensure_indexed()
+    counts = search_index.tag_counts()
+    return jsonify({"tags": [
+        {"tag": tag, "count": count, "total": total}
+        for tag, (count, total) in sorted(counts.items())
+    ]})
+
+@app.route("/api/tags/<path:tag>")
+def api_tag_notes(tag):
+    """
+    List the notes carrying a tag or any tag nested below it:
+    { "tag": ..., "notes": [paths] }
+    """
+    ensure_indexed()
+    tag = tag.lstrip("#").strip("/").lower()
+    notes = sorted(path.replace(os.sep, "/") for path in search_index.tagged(tag))
+    return jsonify({"tag": tag, "notes": notes})
+
+@app.route("/api/query")
+def api_query():
+    """
+    Query notes by frontmatter, like a lightweight Dataview:
+    /api/query?filter=status=draft&filter=priority>=2&sort=-due&limit=50
+    - filter: 'field=value', 'field!=value', 'field>value' (also <, >=, <=),
+      or just 'field' to require it; repeat for AND. '=' on a list field such
+      as tags matches any item.
+    - sort: a field name, '-' prefix for descending; notes missing it come last.
+    Returns { "results": [{ "path", "title", "frontmatter" }], "total": n }.
+    """
+    try:
+        filters = [parse_query_filter(text) for text in request.args.getlist("filter")]
+        limit = int(request.args.get("limit", 0))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    sort = request.args.get("sort", "").strip().lower()
+    descending = sort.startswith("-")
+    ensure_indexed()
+    paths = meta_index.query(filters, sort.lstrip("-") or None, descending)
+    total = len(paths)
+    if limit > 0:
+        paths = paths[:limit]
+    return jsonify({
+        "results": [{
+            "path": path.replace(os.sep, "/"),
+            "title": note_title(path),
+            "frontmatter": meta_index.get(path)
+        } for path in paths],
+        "total": total
+    })
+
 @app.route("/api/search")
 def api_search():
     """
-    Naive substring search in all .md files.
+    Search all .md files.
     Expects a query param: ?q=<query>
+    Supports quoted phrases, AND/OR/NOT (or a leading '-'), parentheses and
+    path:, tag: and title: filters, e.g.
+        "unit layer" AND (tag:gis OR path:SenecaGIS) -draft
     Returns a list of objects like:
     [
       {
@@ -3276,6 +5950,89 @@ def api_search():
     results = search_in_files(query, file_cache)
     return jsonify(results)
 
+@app.route("/api/links")
+def api_links():
+    """
+    Return the outgoing links of a note:
+    { "path": ..., "links": [{ "path", "type": "markdown" | "wiki", "exists" }, ...] }
+    """
+    rel_path = request.args.get("path", "").replace('/', os.sep)
+    if not rel_path:
+        return jsonify({"error": "No file path specified."}), 400
+
+    if not is_safe_path(os.path.join(CONTENT_ROOT, rel_path)):
+        return jsonify({"error": "Invalid path."}), 400
+
+    ensure_indexed()
+    links = [{
+        "path": target.replace(os.sep, "/"),
+        "type": kind,
+        "exists": link_target_exists(target, kind)
+    } for target, kind in link_index.links(rel_path)]
+    return jsonify({"path": rel_path.replace(os.sep, "/"), "links": links})
+
+@app.route("/api/outline")
+def api_outline():
+    """
+    Return the heading outline of a note:
+    { "path": ..., "headings": [{ "level", "text", "slug", "offset" }] }
+    'slug' is the id of the rendered heading, usable as a #fragment.
+    """
+    rel_path = request.args.get("path", "").replace('/', os.sep)
+    if not rel_path:
+        return jsonify({"error": "No file path specified."}), 400
+
+    if not is_safe_path(os.path.join(CONTENT_ROOT, rel_path)):
+        return jsonify({"error": "Invalid path."}), 400
+
+    headings = outline_index.outline(rel_path)
+    if headings is None:
+        content = file_cache.get(rel_path)
+        if content is None:
+            return jsonify({"error": f"File '{rel_path}' not found."}), 404
+        outline_index.add(rel_path, content)
+        headings = outline_index.outline(rel_path)
+    return jsonify({
+        "path": rel_path.replace(os.sep, "/"),
+        "headings": [
+            {"level": level, "text": text, "slug": slug, "offset": offset}
+            for level, text, slug, offset in headings
+        ]
+    })
+
+@app.route("/api/backlinks")
+def api_backlinks():
+    """
+    Return the notes that link to a note: { "path": ..., "backlinks": [paths] }
+    """
+    rel_path = request.args.get("path", "").replace('/', os.sep)
+    if not rel_path:
+        return jsonify({"error": "No file path specified."}), 400
+
+    if not is_safe_path(os.path.join(CONTENT_ROOT, rel_path)):
+        return jsonify({"error": "Invalid path."}), 400
+
+    ensure_indexed()
+    backlinks = sorted(path.replace(os.sep, "/") for path in link_index.backlinks(rel_path))
+    return jsonify({"path": rel_path.replace(os.sep, "/"), "backlinks": backlinks})
+
+@app.route("/api/link_report")
+def api_link_report():
+    """
+    Return the broken links and orphaned notes of the vault:
+    { "broken": [{ "path", "links": [{ "path", "type" }] }], "orphans": [paths], "pending": bool }
+    'pending' is true while the report is still catching up with recent writes.
+    """
+    broken, orphans = link_report.snapshot()
+    return jsonify({
+        "broken": [{
+            "path": source.replace(os.sep, "/"),
+            "links": [{"path": target.replace(os.sep, "/"), "type": kind} for target, kind in links]
+        } for source, links in sorted(broken.items())],
+        "orphans": sorted(path.replace(os.sep, "/") for path in orphans),
+        "pending": link_report.pending or not search_index.complete
+    })
+
 # -------------------------------------------------------------------
 # File Operation API Endpoints
 # -------------------------------------------------------------------
@@ -3297,11 +6054,16 @@ def api_file_raw():
     if not os.path.exists(full_path):
         return jsonify({"error": f"File '{rel_path}' not found."})
 
-    content = get_file_content(full_path)
+    content = write_queue.get(full_path)
+    if content is None:
+        content = get_file_content(full_path)
     if content is None:
         return jsonify({"error": f"Error reading file '{rel_path}'."})
 
-    return jsonify({"content": content})
+    version = content_version(content)
+    response = jsonify({"content": content, "version": version})
+    response.set_etag(version)
+    return response
 
 @app.route("/api/file/create", methods=["POST"])
 def api_file_create():
@@ -3321,7 +6083,10 @@ def api_file_create():
         return jsonify({"error": f"File '{rel_path}' already exists."}), 409
     
     if save_file_content(full_path, data["content"]):
-        refresh_file_cache()
+        with note_lock:
+            if is_cacheable_note(rel_path):
+                update_cached_note(rel_path, data["content"])
+            rebuild_file_tree()
         return jsonify({"success": True, "path": rel_path})
     else:
         return jsonify({"error": f"Failed to create file '{rel_path}'."}), 500
@@ -3330,6 +6095,7 @@ def api_file_create():
 def api_file_edit():
     """
     Edit an existing .md file.
+    Honours an If-Match header carrying the version from /api/file/raw.
     """
     data = request.json
     rel_path = data["path"].replace('/', os.sep) if data and "path" in data else ""
@@ -3348,16 +6114,69 @@ def api_file_edit():
         if rel_path not in file_locks or file_locks[rel_path]["lock_id"] != data["lock_id"]:
             return jsonify({"error": "File is locked by another user."}), 403
     
-    if save_file_content(full_path, data["content"]):
-        refresh_file_cache()
-        return jsonify({"success": True, "path": rel_path})
-    else:
-        return jsonify({"error": f"Failed to save file '{rel_path}'."}), 500
+    content = data["content"]
+    with note_lock:
+        conflict = check_if_match(rel_path, full_path)
+        if conflict:
+            return conflict
+        if not write_note(rel_path, full_path, content, data.get("auto_save")):
+            return jsonify({"error": f"Failed to save file '{rel_path}'."}), 500
+
+    return jsonify({"success": True, "path": rel_path, "version": content_version(content)})
+
+@app.route("/api/file/patch", methods=["POST"])
+def api_file_patch():
+    """
+    Apply text patches to an existing .md file instead of uploading it whole.
+    Expects JSON: { path, base_version, patches: [{ start, end, text }, ...] }
+    (plus the optional lock_id and auto_save of /api/file/edit). Offsets are
+    JavaScript string indices into the content identified by base_version.
+    Returns 409 with the current version if base_version is stale.
+    """
+    data = request.json
+    rel_path = data["path"].replace('/', os.sep) if data and "path" in data else ""
+    if not data or "path" not in data or "base_version" not in data or "patches" not in data:
+        return jsonify({"error": "Missing required fields: path, base_version, patches"}), 400
+
+    full_path = os.path.join(CONTENT_ROOT, rel_path)
+    if not is_safe_path(full_path):
+        return jsonify({"error": "Invalid path."}), 400
+
+    if not os.path.exists(full_path):
+        return jsonify({"error": f"File '{rel_path}' not found."}), 404
+
+    # Check if file is locked
+    if data.get("lock_id"):
+        if rel_path not in file_locks or file_locks[rel_path]["lock_id"] != data["lock_id"]:
+            return jsonify({"error": "File is locked by another user."}), 403
+
+    with note_lock:
+        base_content = read_current_content(rel_path, full_path)
+        if base_content is None:
+            return jsonify({"error": f"Error reading file '{rel_path}'."}), 500
+        current_version = content_version(base_content)
+        if data["base_version"] != current_version:
+            return jsonify({
+                "error": "File has changed since it was loaded.",
+                "conflict": True,
+                "version": current_version
+            }), 409
+
+        try:
+            content = apply_text_patches(base_content, data["patches"])
+        except ValueError as e:
+            return jsonify({"error": f"Invalid patch: {str(e)}"}), 400
+
+        if not write_note(rel_path, full_path, content, data.get("auto_save")):
+            return jsonify({"error": f"Failed to save file '{rel_path}'."}), 500
+
+    return jsonify({"success": True, "path": rel_path, "version": content_version(content)})
 
 @app.route("/api/file/delete", methods=["POST"])
 def api_file_delete():
     """
     Delete a .md file.
+    Honours an If-Match header carrying the version from /api/file/raw.
     """
     data = request.json
     rel_path = data["path"].replace('/', os.sep) if data and "path" in data else ""
@@ -3373,8 +6192,14 @@ def api_file_delete():
         return jsonify({"error": f"File '{rel_path}' not found."}), 404
     
     try:
-        os.remove(full_path)
-        refresh_file_cache()
+        with note_lock:
+            conflict = check_if_match(rel_path, full_path)
+            if conflict:
+                return conflict
+            write_queue.discard(full_path)
+            os.remove(full_path)
+            remove_cached_note(rel_path)
+            rebuild_file_tree()
         return jsonify({"success": True, "path": rel_path})
     except Exception as e:
         return jsonify({"error": f"Failed to delete file '{rel_path}': {str(e)}"}), 500
@@ -3445,7 +6270,8 @@ def api_directory_create():
     
     try:
         os.makedirs(full_path, exist_ok=True)
-        refresh_file_cache()
+        with note_lock:
+            rebuild_file_tree()
         return jsonify({"success": True, "path": rel_path})
     except Exception as e:
         return jsonify({"error": f"Failed to create directory '{rel_path}': {str(e)}"}), 500
@@ -3469,8 +6295,14 @@ def api_directory_delete():
         return jsonify({"error": f"Directory '{rel_path}' not found."}), 404
     
     try:
-        shutil.rmtree(full_path)
-        refresh_file_cache()
+        with note_lock:
+            write_queue.discard(full_path)
+            shutil.rmtree(full_path)
+            prefix = rel_path.rstrip(os.sep) + os.sep
+            for path in file_cache.keys():
+                if path.startswith(prefix):
+                    remove_cached_note(path)
+            rebuild_file_tree()
         return jsonify({"success": True, "path": rel_path})
     except Exception as e:
         return jsonify({"error": f"Failed to delete directory '{rel_path}': {str(e)}"}), 500
@@ -3491,15 +6323,39 @@ def api_directory_rename():
     parent_dir = os.path.dirname(full_path)
     new_full_path = os.path.join(parent_dir, new_name)
     
+    new_rel_path = os.path.relpath(new_full_path, CONTENT_ROOT)
+
+    # Both ends must stay inside the vault (new_name may contain '..')
+    if os.path.realpath(full_path) == os.path.realpath(CONTENT_ROOT) or not is_safe_path(full_path) \
+            or not is_safe_path(new_full_path):
+        return jsonify({"error": "Invalid path."}), 400
+
+    if not os.path.isdir(full_path):
+        return jsonify({"error": f"Directory '{rel_path}' not found."}), 404
+
+    if os.path.exists(new_full_path) and not os.path.samefile(full_path, new_full_path):
+        return jsonify({"error": f"'{new_rel_path}' already exists."}), 409
+
     try:
-        os.rename(full_path, new_full_path)
-        refresh_file_cache()
-        return jsonify({"success": True, "path": os.path.relpath(new_full_path, CONTENT_ROOT).replace(os.sep, "/")})
+        with note_lock:
+            rewritten = move_vault_path(rel_path, full_path, new_rel_path, new_full_path)
+        rebuild_file_tree()
+        return jsonify({
+            "success": True,
+            "path": new_rel_path.replace(os.sep, "/"),
+            "updated_links": [path.replace(os.sep, "/") for path in rewritten]
+        })
     except Exception as e:
         return jsonify({"error": f"Failed to rename directory '{rel_path}': {str(e)}"}), 500
 
 @app.route("/api/file/rename", methods=["POST"])
 def api_file_rename():
+    """
+    Rename a .md file within its directory.
+    Honours an If-Match header carrying the version from /api/file/raw.
+    Links to the note are rewritten in the notes that contain them; their
+    paths are returned as 'updated_links'.
+    """
     data = request.json
     rel_path = data["path"].replace('/', os.sep) if data and "path" in data else ""
     if not data or "new_name" not in data:
@@ -3514,13 +6370,128 @@ def api_file_rename():
     parent_dir = os.path.dirname(full_path)
     new_full_path = os.path.join(parent_dir, new_name)
     
+    new_rel_path = os.path.relpath(new_full_path, CONTENT_ROOT)
+
+    # Both ends must stay inside the vault (new_name may contain '..')
+    if os.path.realpath(full_path) == os.path.realpath(CONTENT_ROOT) or not is_safe_path(full_path) \
+            or not is_safe_path(new_full_path):
+        return jsonify({"error": "Invalid path."}), 400
+
+    if not os.path.isfile(full_path):
+        return jsonify({"error": f"File '{rel_path}' not found."}), 404
+
+    if os.path.exists(new_full_path) and not os.path.samefile(full_path, new_full_path):
+        return jsonify({"error": f"'{new_rel_path}' already exists."}), 409
+
     try:
-        os.rename(full_path, new_full_path)
-        refresh_file_cache()
-        return jsonify({"success": True, "path": os.path.relpath(new_full_path, CONTENT_ROOT).replace(os.sep, "/")})
+        with note_lock:
+            conflict = check_if_match(rel_path, full_path)
+            if conflict:
+                return conflict
+            rewritten = move_vault_path(rel_path, full_path, new_rel_path, new_full_path)
+        rebuild_file_tree()
+        return jsonify({
+            "success": True,
+            "path": new_rel_path.replace(os.sep, "/"),
+            "updated_links": [path.replace(os.sep, "/") for path in rewritten]
+        })
     except Exception as e:
         return jsonify({"error": f"Failed to rename file '{rel_path}': {str(e)}"}), 500
 
+BATCH_OPERATIONS = {"create", "mkdir", "move", "delete"}
+
+@app.route("/api/batch", methods=["POST"])
+def api_batch():
+    """
+    Apply several file operations in one request.
+    Expects JSON: { operations: [
+        { op: "create", path, content },
+        { op: "mkdir", path },
+        { op: "move", path, new_path },
+        { op: "delete", path }          (file or directory)
+    ] }
+    Every path is validated before anything is executed; operations then run
+    in order, each failure is reported without aborting the rest, and the
+    cache, search index and tree are updated once at the end (the cache in
+    place, without re-reading unaffected notes). Returns per-operation results
+    and the new tree.
+    """
+    data = request.json
+    if not data or not isinstance(data.get("operations"), list):
+        return jsonify({"error": "Missing required field: operations"}), 400
+
+    # Validate everything up front
+    operations = []
+    errors = []
+    for i, operation in enumerate(data["operations"]):
+        op = operation.get("op") if isinstance(operation, dict) else None
+        if op not in BATCH_OPERATIONS or not operation.get("path") or not isinstance(operation["path"], str):
+            errors.append(f"Operation {i}: expected op in {sorted(BATCH_OPERATIONS)} and a path")
+            continue
+        if op == "create" and not isinstance(operation.get("content"), str):
+            errors.append(f"Operation {i}: create requires string content")
+            continue
+        if op == "move" and (not operation.get("new_path") or not isinstance(operation["new_path"], str)):
+            errors.append(f"Operation {i}: move requires new_path")
+            continue
+        rel_path = operation["path"].replace('/', os.sep)
+        new_rel_path = operation.get("new_path", "").replace('/', os.sep)
+        full_path = os.path.join(CONTENT_ROOT, rel_path)
+        new_full_path = os.path.join(CONTENT_ROOT, new_rel_path) if op == "move" else None
+        if os.path.realpath(full_path) == os.path.realpath(CONTENT_ROOT) or not is_safe_path(full_path) \
+                or (new_full_path and not is_safe_path(new_full_path)):
+            errors.append(f"Operation {i}: invalid path")
+            continue
+        operations.append((op, rel_path, full_path, new_rel_path, new_full_path, operation))
+    if errors:
+        return jsonify({"error": "Invalid batch; nothing was changed.", "errors": errors}), 400
+
+    results = []
+    with note_lock:
+        for op, rel_path, full_path, new_rel_path, new_full_path, operation in operations:
+            try:
+                if op == "create":
+                    if os.path.exists(full_path):
+                        raise FileExistsError(f"'{rel_path}' already exists")
+                    if not write_queue.write(full_path, operation["content"]):
+                        raise OSError(f"failed to write '{rel_path}'")
+                    if is_cacheable_note(rel_path):
+                        update_cached_note(rel_path, operation["content"])
+                elif op == "mkdir":
+                    os.makedirs(full_path, exist_ok=True)
+                elif op == "move":
+                    if not os.path.exists(full_path):
+                        raise FileNotFoundError(f"'{rel_path}' not found")
+                    if os.path.exists(new_full_path):
+                        raise FileExistsError(f"'{new_rel_path}' already exists")
+                    os.makedirs(os.path.dirname(new_full_path), exist_ok=True)
+                    move_vault_path(rel_path, full_path, new_rel_path, new_full_path)
+                elif op == "delete":
+                    if not os.path.exists(full_path):
+                        raise FileNotFoundError(f"'{rel_path}' not found")
+                    write_queue.discard(full_path)
+                    if os.path.isdir(full_path):
+                        shutil.rmtree(full_path)
+                        prefix = rel_path.rstrip(os.sep) + os.sep
+                        for path in file_cache.keys():
+                            if path.startswith(prefix):
+                                remove_cached_note(path)
+                    else:
+                        os.remove(full_path)
+                        remove_cached_note(rel_path)
+                results.append({"op": op, "path": rel_path.replace(os.sep, "/"), "success": True})
+            except Exception as e:
+                results.append({"op": op, "path": rel_path.replace(os.sep, "/"), "success": False, "error": str(e)})
+
+        # One consolidated tree update for the whole batch
+        rebuild_file_tree()
+
+    return jsonify({
+        "success": all(result["success"] for result in results),
+        "results": results,
+        "tree": file_tree
+    })
+
 @app.route("/api/settings", methods=["GET"])
 def get_settings():
     try:
@@ -3555,89 +6526,420 @@ def hard_reset():
     Endpoint to save any changes and restart the service.
     """
     try:
-        # Save any pending changes (if needed)
-        # Then restart the service
+        # Save any pending changes, then restart the service
+        write_queue.flush()
         os.system("sudo systemctl restart observe.service")
         return jsonify({"status": "success", "message": "Service restarted successfully"})
     except Exception as e:
         logger.error(f"Error in hard reset: {str(e)}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+UPLOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_FIELD_MAX = 64 * 1024  # Plain form fields (e.g. target_dir) are small
+
+def receive_multipart_files(stream, boundary, spool_dir):
+    """
+    Parse a multipart/form-data body incrementally as it is read from 'stream'.
+    Plain fields are returned in a dict; each file part is written straight
+    into a dot-prefixed temporary file in 'spool_dir' as its data arrives, so
+    memory use does not depend on the size of the upload. Plain fields larger
+    than UPLOAD_FIELD_MAX raise RequestEntityTooLarge.
+    Returns (fields, files) where files is a list of (field_name, filename, tmp_path).
+    """
+    # No max_form_memory_size: Werkzeug applies it to the decoder's whole
+    # unconsumed buffer, file data included, so field sizes are capped below
+    decoder = MultipartDecoder(boundary)
+    fields = {}
+    files = []
+    current = None
+    buffer = []
+    out = None
+    try:
+        event = None
+        while not isinstance(event, Epilogue):
+            chunk = stream.read(UPLOAD_CHUNK_SIZE)
+            decoder.receive_data(chunk or None)
+            event = decoder.next_event()
+            while not isinstance(event, (Epilogue, NeedData)):
+                if isinstance(event, Field):
+                    current = event
+                    buffer = []
+                elif isinstance(event, File):
+                    current = event
+                    fd, tmp_path = tempfile.mkstemp(dir=spool_dir, prefix=".upload-", suffix=".tmp")
+                    out = os.fdopen(fd, "wb")
+                    files.append((event.name, event.filename, tmp_path))
+                elif isinstance(event, Data):
+                    if isinstance(current, Field):
+                        buffer.append(event.data)
+                        if sum(len(data) for data in buffer) > UPLOAD_FIELD_MAX:
+                            raise RequestEntityTooLarge(f"Form field '{current.name}' is too large.")
+                        if not event.more_data:
+                            fields[current.name] = b"".join(buffer).decode("utf-8", "replace")
+                    else:
+                        out.write(event.data)
+                        if not event.more_data:
+                            out.close()
+                            out = None
+                event = decoder.next_event()
+            if not chunk and not isinstance(event, Epilogue):
+                raise ValueError("Upload ended unexpectedly.")
+        return fields, files
+    except BaseException:
+        if out:
+            out.close()
+        for _, _, tmp_path in files:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+
+def commit_uploaded_file(tmp_path, full_path):
+    """
+    Durably move a spooled upload into place: fsync it, then rename it over
+    its destination. Returns the file's text for the cache, or None if it is
+    not valid UTF-8.
+    """
+    with open(tmp_path, "rb+") as f:
+        data = f.read()
+        os.fsync(f.fileno())
+    os.chmod(tmp_path, 0o644)
+    directory = os.path.dirname(full_path)
+    os.makedirs(directory, exist_ok=True)
+    try:
+        os.replace(tmp_path, full_path)
+    except OSError:
+        # Destination is on another filesystem
+        shutil.move(tmp_path, full_path)
+    fsync_directory(directory)
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+
 @app.route("/api/file/upload", methods=["POST"])
 def api_file_upload():
     """
     Upload one or more .md files.
+    The multipart body is parsed as it streams in and each file is spooled to
+    disk, so uploads are limited by max_upload_size_mb rather than held in
+    memory. Files are then fsynced and renamed into place by a worker pool,
+    and added straight into the content cache and search index, with a single
+    tree rebuild at the end.
     """
+    spooled = []
     try:
-        if 'files' not in request.files:
+        mimetype, options = parse_options_header(request.content_type or "")
+        boundary = options.get("boundary")
+        if mimetype != "multipart/form-data" or not boundary:
             return jsonify({"error": "No files provided"}), 400
-        
-        files = request.files.getlist('files')
-        if not files or all(file.filename == '' for file in files):
-            return jsonify({"error": "No files selected"}), 400
-        
+
+        if request.content_length and request.content_length > MAX_UPLOAD_SIZE_MB * 1024 * 1024:
+            return jsonify({"error": f"Upload exceeds {MAX_UPLOAD_SIZE_MB} MB"}), 413
+
+        fields, spooled = receive_multipart_files(request.stream, boundary.encode("latin-1"), CONTENT_ROOT)
+
+        files = [(filename, tmp_path) for name, filename, tmp_path in spooled if name == "files" and filename]
+        if not files:
+            return jsonify({"error": "No files selected" if spooled else "No files provided"}), 400
+
+        # Get the target directory from the request
+        target_dir = fields.get('target_dir', '').strip()
+
         uploaded_files = []
         errors = []
-        
-        for file in files:
-            if file.filename == '':
-                continue
-                
+        jobs = []
+        claimed = set()
+
+        for original_name, tmp_path in files:
             # Check if it's a .md file
-            if not file.filename.lower().endswith('.md'):
-                errors.append(f"'{file.filename}' is not a .md file")
+            if not original_name.lower().endswith('.md'):
+                errors.append(f"'{original_name}' is not a .md file")
                 continue
-            
+
             # Secure the filename
-            filename = secure_filename(file.filename)
-            
-            # Get the target directory from the request
-            target_dir = request.form.get('target_dir', '').strip()
-            
+            filename = secure_filename(original_name)
+
             # Construct the full path
             if target_dir:
                 rel_path = os.path.join(target_dir, filename).replace(os.sep, '/')
             else:
                 rel_path = filename
-            
+
             full_path = os.path.join(CONTENT_ROOT, rel_path)
-            
+
             # Check if path is safe
             if not is_safe_path(full_path):
                 errors.append(f"'{filename}' has an invalid path")
                 continue
-            
-            # Check if file already exists
-            if os.path.exists(full_path):
+
+            # Check if file already exists (on disk or earlier in this upload)
+            if os.path.exists(full_path) or full_path in claimed:
                 errors.append(f"'{filename}' already exists")
                 continue
-            
-            try:
-                # Ensure the directory exists
-                os.makedirs(os.path.dirname(full_path), exist_ok=True)
-                
-                # Save the file
-                file.save(full_path)
+
+            claimed.add(full_path)
+            jobs.append((filename, rel_path, full_path, tmp_path))
+
+        with ThreadPoolExecutor(max_workers=max(1, UPLOAD_WORKERS), thread_name_prefix="observe-upload") as pool:
+            futures = [(job, pool.submit(commit_uploaded_file, job[3], job[2])) for job in jobs]
+            for (filename, rel_path, full_path, tmp_path), future in futures:
+                try:
+                    content = future.result()
+                except Exception as e:
+                    errors.append(f"Failed to save '{filename}': {str(e)}")
+                    continue
                 uploaded_files.append(rel_path)
-                
+                if content is not None:
+                    update_cached_note(rel_path.replace('/', os.sep), content)
                 logger.info(f"Successfully uploaded file: {rel_path}")
-                
-            except Exception as e:
-                errors.append(f"Failed to save '{filename}': {str(e)}")
-        
-        # Refresh the file cache
+
+        # One tree rebuild for the whole upload
         if uploaded_files:
-            refresh_file_cache()
-        
+            rebuild_file_tree()
+
         return jsonify({
             "success": True,
             "uploaded_files": uploaded_files,
             "errors": errors
         })
-        
+
+    except RequestEntityTooLarge as e:
+        return jsonify({"error": e.description}), 413
     except Exception as e:
         logger.error(f"Error in file upload: {str(e)}")
         return jsonify({"error": f"Upload failed: {str(e)}"}), 500
+    finally:
+        # Remove spooled files that were rejected or failed to commit
+        for _, _, tmp_path in spooled:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+# -------------------------------------------------------------------
+# Archive export / import
+# -------------------------------------------------------------------
+ARCHIVE_CHUNK_SIZE = 64 * 1024
+
+class ZipStreamBuffer:
+    """
+    Write-only file object that collects zipfile output so a generator can
+    hand it to the client chunk by chunk. It can tell() but not seek(), which
+    makes zipfile write streaming-friendly local headers and data descriptors.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def is_spool_file(name):
+    """
+    Return True for the app's own temporary files (atomic saves, upload spools).
+    """
+    return name.startswith(".") and name.endswith(".tmp")
+
+def generate_zip(root_dir):
+    """
+    Yield a zip archive of every file under 'root_dir' piece by piece, reading
+    each file in chunks, so neither the archive nor any file is held in memory.
+    """
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for dirpath, dirnames, filenames in os.walk(root_dir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if is_spool_file(filename):
+                    continue
+                full_path = os.path.join(dirpath, filename)
+                arcname = os.path.relpath(full_path, root_dir).replace(os.sep, "/")
+                try:
+                    info = zipfile.ZipInfo.from_file(full_path, arcname)
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    with open(full_path, "rb") as src, archive.open(info, "w") as dest:
+                        while True:
+                            chunk = src.read(ARCHIVE_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            dest.write(chunk)
+                            yield buffer.drain()
+                except OSError as e:
+                    logger.error(f"Skipping {full_path} in export: {str(e)}")
+                yield buffer.drain()
+    yield buffer.drain()
+
+@app.route("/api/export")
+def api_export():
+    """
+    Download a directory (the whole vault if no path is given) as a zip file.
+    The archive is generated on the fly while it is sent.
+    """
+    rel_path = request.args.get("path", "").strip().strip("/").replace('/', os.sep)
+    full_path = os.path.join(CONTENT_ROOT, rel_path)
+    if not is_safe_path(full_path):
+        return jsonify({"error": "Invalid path."}), 400
+
+    if not os.path.isdir(full_path):
+        return jsonify({"error": f"Directory '{rel_path}' not found."}), 404
+
+    name = os.path.basename(os.path.normpath(full_path)) or "vault"
+    return Response(
+        generate_zip(full_path),
+        mimetype="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{secure_filename(name) or "vault"}.zip"'}
+    )
+
+def iter_archive_members(archive_path):
+    """
+    Yield (name, size, open_member) for every regular file in a zip or tar
+    archive, reading the archive member by member. Directories, links and
+    special files are skipped. Raises ValueError for unsupported archives.
+    """
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    yield info.filename, info.file_size, lambda info=info: archive.open(info)
+    elif tarfile.is_tarfile(archive_path):
+        with tarfile.open(archive_path, "r:*") as archive:
+            for member in archive:
+                if member.isfile():
+                    yield member.name, member.size, lambda member=member: archive.extractfile(member)
+    else:
+        raise ValueError("Unsupported archive format; expected zip or tar.")
+
+def safe_archive_path(name, target_full_path):
+    """
+    Map an archive member name to a destination under 'target_full_path', or
+    return None for absolute paths, '..' components or anything that would
+    escape CONTENT_ROOT.
+    """
+    name = name.replace("\\", "/")
+    parts = [part for part in name.split("/") if part not in ("", ".")]
+    if not parts or name.startswith("/") or ".." in parts or ":" in parts[0]:
+        return None
+    full_path = os.path.join(target_full_path, *parts)
+    return full_path if is_safe_path(full_path) else None
+
+@app.route("/api/import", methods=["POST"])
+def api_import():
+    """
+    Unpack an uploaded zip or tar archive (multipart field 'archive') into
+    'target_dir' (default: the vault root). The upload is streamed to disk,
+    then extracted member by member; every member path is checked, existing
+    files are skipped unless 'overwrite' is 'true', and each file is moved
+    into place atomically. Imported notes are added to the cache and search
+    index directly, with one tree rebuild at the end.
+    """
+    spooled = []
+    try:
+        mimetype, options = parse_options_header(request.content_type or "")
+        boundary = options.get("boundary")
+        if mimetype != "multipart/form-data" or not boundary:
+            return jsonify({"error": "No archive provided"}), 400
+
+        if request.content_length and request.content_length > MAX_UPLOAD_SIZE_MB * 1024 * 1024:
+            return jsonify({"error": f"Upload exceeds {MAX_UPLOAD_SIZE_MB} MB"}), 413
+
+        fields, spooled = receive_multipart_files(request.stream, boundary.encode("latin-1"), CONTENT_ROOT)
+        archives = [tmp_path for name, filename, tmp_path in spooled if name == "archive" and filename]
+        if not archives:
+            return jsonify({"error": "No archive provided"}), 400
+
+        target_dir = fields.get("target_dir", "").strip().strip("/").replace('/', os.sep)
+        overwrite = fields.get("overwrite", "").lower() == "true"
+        target_full_path = os.path.join(CONTENT_ROOT, target_dir)
+        if not is_safe_path(target_full_path):
+            return jsonify({"error": "Invalid target directory."}), 400
+
+        imported_files = []
+        errors = []
+        total_size = 0
+        size_limit = MAX_UPLOAD_SIZE_MB * 1024 * 1024
+
+        # Members are extracted without holding note_lock; it is only taken to
+        # move each finished file into place and update the cache
+        directories = set()
+        for name, size, open_member in iter_archive_members(archives[0]):
+            full_path = safe_archive_path(name, target_full_path)
+            if full_path is None or is_spool_file(os.path.basename(full_path)):
+                errors.append(f"'{name}' has an invalid path")
+                continue
+            total_size += size
+            if total_size > size_limit:
+                errors.append(f"Stopped at '{name}': extracted size exceeds {MAX_UPLOAD_SIZE_MB} MB")
+                break
+            rel_path = os.path.relpath(full_path, CONTENT_ROOT)
+            if os.path.exists(full_path) and not overwrite:
+                errors.append(f"'{rel_path.replace(os.sep, '/')}' already exists")
+                continue
+
+            tmp_path = None
+            try:
+                directory = os.path.dirname(full_path)
+                os.makedirs(directory, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".import-", suffix=".tmp")
+                with os.fdopen(fd, "wb") as dest, open_member() as src:
+                    shutil.copyfileobj(src, dest, ARCHIVE_CHUNK_SIZE)
+                    dest.flush()
+                    os.fsync(dest.fileno())
+                os.chmod(tmp_path, 0o644)
+                content = get_file_content(tmp_path) if is_cacheable_note(rel_path) else None
+                with note_lock:
+                    if os.path.exists(full_path) and not overwrite:
+                        errors.append(f"'{rel_path.replace(os.sep, '/')}' already exists")
+                        continue
+                    write_queue.discard(full_path)
+                    os.replace(tmp_path, full_path)
+                    tmp_path = None
+                    if content is not None:
+                        update_cached_note(rel_path, content)
+                directories.add(directory)
+            except Exception as e:
+                errors.append(f"Failed to extract '{name}': {str(e)}")
+                continue
+            finally:
+                if tmp_path and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+            imported_files.append(rel_path.replace(os.sep, "/"))
+
+        # Make the renames durable, then one tree rebuild for the whole archive
+        if imported_files:
+            for directory in directories:
+                fsync_directory(directory)
+            with note_lock:
+                rebuild_file_tree()
+
+        return jsonify({
+            "success": True,
+            "imported_files": imported_files,
+            "errors": errors
+        })
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except RequestEntityTooLarge as e:
+        return jsonify({"error": e.description}), 413
+    except Exception as e:
+        logger.error(f"Error in archive import: {str(e)}")
+        return jsonify({"error": f"Import failed: {str(e)}"}), 500
+    finally:
+        for _, _, tmp_path in spooled:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
 # -------------------------------------------------------------------
 # Main entry point